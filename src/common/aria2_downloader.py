@@ -34,6 +34,7 @@ class Downloader:
         self.dest = dest
         self.hash_type = None
         self.hash_value = None
+        self.rate_limit = 0
         self.process = None
         self.secret = ''.join(format(ord(x), 'x') for x in os.urandom(10))
         self.gid = 'DEADC0D9BEEFFACE'
@@ -58,6 +59,16 @@ class Downloader:
         self.hash_type = hash_type
         self.hash_value = hash_value
 
+    def limit_speed(self, kbytes=-1):
+        # same interface as pySmartDL, a negative value removes the limit
+        self.rate_limit = max(kbytes, 0)
+        if self.process and not self.failed:
+            try:
+                self.server.aria2.changeGlobalOption('token:'+self.secret,
+                    {'max-overall-download-limit': '{}K'.format(self.rate_limit)})
+            except Exception as e:
+                debugger('changing download limit failed {}'.format(e))
+
     def start(self, blocking=False):
         checksum_opts = []
 
@@ -76,7 +87,8 @@ class Downloader:
             '--rpc-listen-port={}'.format(port),
             '--enable-rpc=true',
             '--rpc-listen-all',
-            '--rpc-secret={}'.format(self.secret)
+            '--rpc-secret={}'.format(self.secret),
+            '--max-overall-download-limit={}K'.format(self.rate_limit)
             ]
         cmd_args = l1 + checksum_opts
         debugger('running [{}]'.format(cmd_args))
@@ -159,6 +171,14 @@ class Downloader:
 
         return proportion
 
+    def get_dl_size(self):
+        # aria2 is started without --continue, so all of it was transferred
+        self.getAriaStatus()
+        try:
+            return int(self.ariaStatus.get('completedLength', 0))
+        except ValueError:
+            return 0
+
     def get_speed(self, human=True):
         self.getAriaStatus()
         if 'downloadSpeed' in self.ariaStatus:
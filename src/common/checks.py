@@ -0,0 +1,81 @@
+#!/usr/bin/env python
+
+# checks.py
+#
+# Copyright (C) 2015 Kano Computing Ltd.
+# License: http://www.gnu.org/licenses/gpl-2.0.txt GNU General Public License v2
+#
+#
+# Running dependency checks concurrently
+#
+# The dependency checks (internet connection, tools, OS info, free space) do not
+# depend on each other, so we run each of them in its own thread. The dependency
+# screen then takes as long as the slowest check instead of the sum of all of them.
+#
+# Every check has its own timeout and all of them share an overall deadline.
+# A check which does not finish in time is given its default result and left
+# running in a daemon thread, so it cannot hold up the UI or the exit.
+
+
+import time
+import threading
+
+from src.common.utils import debugger
+
+
+# The overall time budget for all dependency checks, in seconds
+DEPENDENCY_DEADLINE = 20
+
+
+class Check(threading.Thread):
+    '''
+    A single dependency check, running the given function in a daemon thread.
+
+    If the function raises an exception or does not return within the timeout,
+    the result is the default value.
+    '''
+
+    def __init__(self, name, function, timeout, default=None):
+        super(Check, self).__init__()
+        self.daemon = True
+
+        self.name = name
+        self.function = function
+        self.timeout = timeout
+        self.result = default
+        self.duration = None
+
+    def run(self):
+        start = time.time()
+        try:
+            self.result = self.function()
+        except Exception as e:
+            debugger('[ERROR] Dependency check "{}" failed: {}'.format(self.name, e))
+        self.duration = time.time() - start
+
+
+def run_checks(checks, deadline=DEPENDENCY_DEADLINE):
+    '''
+    This method runs the given Check threads concurrently, waits for them
+    and returns a dictionary with the result of each check by name.
+    '''
+
+    start = time.time()
+    for check in checks:
+        check.start()
+
+    results = dict()
+    for check in checks:
+        elapsed = time.time() - start
+        check.join(max(min(check.timeout, deadline) - elapsed, 0))
+
+        if check.duration is None:
+            debugger('[ERROR] Dependency check "{}" timed out after {:.2f}s'
+                     .format(check.name, time.time() - start))
+        else:
+            debugger('Dependency check "{}" took {:.2f}s'.format(check.name, check.duration))
+
+        results[check.name] = check.result
+
+    debugger('Dependency checks took {:.2f}s'.format(time.time() - start))
+    return results
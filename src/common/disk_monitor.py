@@ -0,0 +1,73 @@
+#!/usr/bin/env python
+
+# disk_monitor.py
+#
+# Copyright (C) 2015 Kano Computing Ltd.
+# License: http://www.gnu.org/licenses/gpl-2.0.txt GNU General Public License v2
+#
+#
+# Keeping the list of disks up to date in the background
+#
+# Instead of scanning for disks on the UI thread every time the user opens the
+# disks ComboBox, the DiskMonitor thread keeps the current list of disks and
+# notifies the UI of disks being inserted or removed through Qt signals.
+#
+# The watching itself is done by the DiskWatcher, see disk_watcher.py
+
+
+import threading
+from PyQt4 import QtCore
+
+from src.common.disk_watcher import DiskWatcher
+
+
+class DiskMonitor(QtCore.QThread):
+    '''
+    This thread maintains the list of disks returned by the given platform
+    get_disks_list() method and emits a signal for every disk added or removed.
+
+    The list is scanned as soon as the thread starts, so the initial
+    disks are reported through the notifyDiskAdded signal as well,
+    followed by the notifyScanned signal.
+    '''
+
+    # QT signals must be defined here and not in init
+    notifyDiskAdded = QtCore.pyqtSignal(object)
+    notifyDiskRemoved = QtCore.pyqtSignal(object)
+    notifyScanned = QtCore.pyqtSignal()
+
+    def __init__(self, get_disks_list, parent=None):
+        super(DiskMonitor, self).__init__(parent)
+        self.get_disks_list = get_disks_list
+
+        self.watcher = None
+        self.scanned = threading.Event()
+        self.stopped = threading.Event()
+
+    def stop(self):
+        self.stopped.set()
+
+    def getDisks(self):
+        if not self.watcher:
+            return list()
+        return self.watcher.getDisks()
+
+    def rescan(self):
+        added, removed = self.watcher.rescan()
+
+        for disk in removed:
+            self.notifyDiskRemoved.emit(disk)
+        for disk in added:
+            self.notifyDiskAdded.emit(disk)
+
+    def run(self):
+        self.watcher = DiskWatcher(self.get_disks_list)
+        self.rescan()
+        self.scanned.set()
+        self.notifyScanned.emit()
+
+        while not self.stopped.is_set():
+            if self.watcher.wait(timeout=1):
+                self.rescan()
+
+        self.watcher.close()
@@ -0,0 +1,150 @@
+#!/usr/bin/env python
+
+# disk_probe.py
+#
+# Copyright (C) 2015 Kano Computing Ltd.
+# License: http://www.gnu.org/licenses/gpl-2.0.txt GNU General Public License v2
+#
+#
+# Probing disks concurrently
+#
+# Getting the name and size of a disk means asking the device itself, which can
+# take seconds or hang altogether on a flaky card reader. Instead of probing the
+# disks one after another, the DiskProber runs a few probes at the same time and
+# gives each of them a timeout. A disk which is still being probed when its time is
+# up is listed with the result of its last probe, or left out if it was never probed.
+# Its probe keeps running in the background without taking up a slot, and the
+# result is then used by the next scan.
+
+
+import time
+import math
+import threading
+
+from src.common.utils import debugger
+
+
+# How many disks are probed at the same time
+PROBE_WORKERS = 4
+
+# How long a single disk may take to be probed, in seconds
+PROBE_TIMEOUT = 5
+
+
+class DiskProbe(threading.Thread):
+    '''
+    This daemon thread runs the probe function for a single disk,
+    once one of the shared slots is free.
+    '''
+
+    def __init__(self, disk_id, probe, slots):
+        super(DiskProbe, self).__init__()
+        self.daemon = True
+
+        self.disk_id = disk_id
+        self.probe = probe
+        self.slots = slots
+        self.result = None
+        self.started = None
+        self.duration = None
+        self.done = threading.Event()
+
+        # the slot is given back by whoever is first, this thread or the prober giving up
+        self.slot_lock = threading.Lock()
+        self.slot_held = False
+
+    def run(self):
+        self.slots.acquire()
+        with self.slot_lock:
+            self.slot_held = True
+
+        self.started = time.time()
+        try:
+            self.result = self.probe(self.disk_id)
+        except Exception as e:
+            debugger('[ERROR] Probing {} failed: {}'.format(self.disk_id, e))
+        self.duration = time.time() - self.started
+
+        self.releaseSlot()
+        self.done.set()
+
+    def releaseSlot(self):
+        with self.slot_lock:
+            if self.slot_held:
+                self.slot_held = False
+                self.slots.release()
+
+
+class DiskProber(object):
+    '''
+    This class probes a list of disks with the given probe(disk_id) function
+    using at most workers threads at the same time.
+    '''
+
+    def __init__(self, probe, workers=PROBE_WORKERS, timeout=PROBE_TIMEOUT):
+        self.probe = probe
+        self.workers = workers
+        self.timeout = timeout
+        self.slots = threading.BoundedSemaphore(workers)
+
+        # the probes which did not finish in time, and the last result of every disk, by disk id
+        self.probing = dict()
+        self.results = dict()
+
+    def probe_disks(self, disk_ids):
+        '''
+        This method returns a list of (disk_id, result) tuples for the disks
+        probed successfully. Disks taking longer are reported as still probing,
+        with the result of their last probe if they had one.
+        '''
+
+        start = time.time()
+        probes = list()
+        for disk_id in disk_ids:
+            # reuse the probe started by a previous scan if it is still running
+            probe = self.probing.pop(disk_id, None)
+            if not probe:
+                probe = DiskProbe(disk_id, self.probe, self.slots)
+                probe.start()
+            probes.append(probe)
+
+        # even if all the slots are taken by hung probes, we give up eventually
+        rounds = math.ceil(len(probes) / float(self.workers))
+        deadline = start + self.timeout * max(rounds, 1)
+
+        results = list()
+        for probe in probes:
+            while not probe.done.wait(0.1):
+                if probe.started and time.time() - probe.started > self.timeout:
+                    break
+                if time.time() > deadline:
+                    break
+
+            if probe.done.is_set():
+                debugger('Probing {} took {:.2f}s'.format(probe.disk_id, probe.duration))
+                if probe.result is not None:
+                    self.results[probe.disk_id] = probe.result
+                    results.append((probe.disk_id, probe.result))
+                continue
+
+            # a hung probe must not keep the other disks from being probed
+            probe.releaseSlot()
+            self.probing[probe.disk_id] = probe
+
+            # keep listing a disk which was probed before, rather than removing and adding it again
+            if probe.disk_id in self.results:
+                debugger('[ERROR] Still probing {}, using its last result'.format(probe.disk_id))
+                results.append((probe.disk_id, self.results[probe.disk_id]))
+            else:
+                debugger('[ERROR] Still probing {}, leaving it out for now'.format(probe.disk_id))
+
+        # forget about the disks which have been removed in the meantime
+        for disk_id in self.probing.keys():
+            if disk_id not in disk_ids:
+                del self.probing[disk_id]
+        for disk_id in self.results.keys():
+            if disk_id not in disk_ids:
+                del self.results[disk_id]
+
+        debugger('Probing {} disk(s) took {:.2f}s'.format(len(probes), time.time() - start))
+        return results
@@ -0,0 +1,148 @@
+#!/usr/bin/env python
+
+# disk_watcher.py
+#
+# Copyright (C) 2015 Kano Computing Ltd.
+# License: http://www.gnu.org/licenses/gpl-2.0.txt GNU General Public License v2
+#
+#
+# Watching for disks being inserted and removed
+#
+# The DiskWatcher keeps the current list of disks and tells which disks were added
+# or removed since the last scan. It is used by the DiskMonitor thread of the UI
+# and by the station mode of the command line burner, so it does not use Qt.
+#
+# On Linux, we listen for kernel uevents on a netlink socket and only scan when
+# a block device has changed. Elsewhere, or if netlink is not available,
+# we simply scan periodically and compare with the previous list.
+
+
+import time
+import select
+import socket
+
+from src.common.utils import debugger
+
+
+# netlink protocol and multicast group for kernel uevents, see linux/netlink.h
+NETLINK_KOBJECT_UEVENT = 15
+UEVENT_KERNEL_GROUP = 1
+UEVENT_BUFFER_SIZE = 8192
+
+# How often we scan for disks when there are no uevents, in seconds
+POLL_INTERVAL = 3
+
+# Inserting a card causes a burst of uevents, we scan once they settle, in seconds
+UEVENT_SETTLE_TIME = 0.5
+
+
+class DiskWatcher(object):
+    '''
+    This class maintains the list of disks returned by the given platform
+    get_disks_list() method and reports the changes between scans.
+    '''
+
+    def __init__(self, get_disks_list):
+        self.get_disks_list = get_disks_list
+        self.disks = list()
+
+        # without uevents, the time waited since the last scan
+        self.waited = 0
+
+        self.uevents = open_uevent_socket()
+        if self.uevents:
+            debugger('Watching for disks with netlink uevents')
+        else:
+            debugger('Watching for disks every {} seconds'.format(POLL_INTERVAL))
+
+    def getDisks(self):
+        # the list is only replaced, never modified, so returning it is thread-safe
+        return list(self.disks)
+
+    def rescan(self):
+        '''
+        This method scans for disks and returns the lists of disks added
+        and removed since the previous scan.
+        '''
+
+        try:
+            disks = self.get_disks_list()
+        except Exception as e:
+            debugger('[ERROR] Scanning drives failed: {}'.format(e))
+            return [], []
+
+        removed = [disk for disk in self.disks if disk not in disks]
+        added = [disk for disk in disks if disk not in self.disks]
+        self.disks = disks
+
+        for disk in removed:
+            debugger('Disk removed {}'.format(disk))
+        for disk in added:
+            debugger('Disk added {}'.format(disk))
+
+        return added, removed
+
+    def wait(self, timeout=1):
+        '''
+        This method waits for up to timeout seconds and returns True if the disks
+        may have changed since and should be scanned again.
+        '''
+
+        if not self.uevents:
+            time.sleep(timeout)
+            self.waited += timeout
+            if self.waited < POLL_INTERVAL:
+                return False
+            self.waited = 0
+            return True
+
+        if not wait_for_block_uevent(self.uevents, timeout):
+            return False
+
+        # wait for the burst of events to settle before scanning once
+        while wait_for_block_uevent(self.uevents, UEVENT_SETTLE_TIME):
+            pass
+        return True
+
+    def close(self):
+        if self.uevents:
+            self.uevents.close()
+            self.uevents = None
+
+
+def open_uevent_socket():
+    if not hasattr(socket, 'AF_NETLINK'):
+        return None
+
+    try:
+        uevents = socket.socket(socket.AF_NETLINK, socket.SOCK_DGRAM, NETLINK_KOBJECT_UEVENT)
+        uevents.bind((0, UEVENT_KERNEL_GROUP))
+        return uevents
+    except socket.error as e:
+        debugger('[ERROR] Opening the uevent socket failed: {}'.format(e))
+        return None
+
+
+def wait_for_block_uevent(uevents, timeout):
+    '''
+    This method returns True if a uevent for a block device was received
+    within the timeout. Other uevents, e.g. USB interfaces, are ignored.
+    '''
+
+    deadline = time.time() + timeout
+    while True:
+        remaining = deadline - time.time()
+        if remaining <= 0:
+            return False
+
+        readable, _, _ = select.select([uevents], [], [], remaining)
+        if not readable:
+            return False
+
+        # the message is e.g. 'add@/devices/...\0ACTION=add\0...SUBSYSTEM=block\0...'
+        try:
+            message = uevents.recv(UEVENT_BUFFER_SIZE)
+        except socket.error:
+            return False
+        if '\0SUBSYSTEM=block\0' in message:
+            return True
@@ -9,7 +9,7 @@
 # Downloading Kano OS module
 #
 # The module uses aria2 or PySmartDL to download the OS image file and
-# urllib2 to get the information about the latest OS release.
+# the metadata cache to get the information about the latest OS release.
 #
 # The downloading process is also required to report it's progress
 # back to the UI, therefore we run  a child process
@@ -19,29 +19,52 @@
 
 
 import time
-import json
-import urllib2
+import logging
 import traceback
 
 from src.common.pySmartDL.pySmartDL import SmartDL, HashFailedException
 from src.common.aria2_downloader import Downloader as AriaDownloader
+from src.common.metadata_cache import fetch_json
+from src.common.trace import span, add_span
+from src.common.metrics import downloaded_bytes
 from src.common.utils import debugger, LATEST_OS_INFO_URL, BYTES_IN_MEGABYTE
-from src.common.utils import BURNER_VERSION
-from src.common.errors import DOWNLOAD_ERROR, MD5_ERROR, OLDBURNER_ERROR
+from src.common.utils import BURNER_VERSION, DOWNLOAD_RATE_LIMIT
+from src.common.errors import DOWNLOAD_ERROR, MD5_ERROR, OLDBURNER_ERROR, CANCELLED_ERROR
 from src.common.paths import temp_path
 
 
+class DebuggerLogHandler(logging.Handler):
+    '''
+    This logging handler forwards the messages of PySmartDL to the debugger.
+    '''
+
+    def emit(self, record):
+        debugger('[pySmartDL] {}'.format(self.format(record)))
+
+
+pysmartdl_logger = logging.getLogger('pySmartDL')
+pysmartdl_logger.setLevel(logging.DEBUG)
+pysmartdl_logger.addHandler(DebuggerLogHandler())
+
+
 class Downloader(SmartDL):
     '''
     This class acts as a PySmartDL wrapper which fixes a process killing bug.
 
     When the application is closed via the [X] button, we want all downloading
     threads to be killed immediately and cleaned up.
+
+    It also sends the PySmartDL log to the debugger and lets it choose the number
+    of connections based on the measured download speed.
     '''
 
     def __init__(self, *args, **kwargs):
+        kwargs.setdefault('logger', pysmartdl_logger)
         SmartDL.__init__(self, *args, **kwargs)
 
+        # high-latency links need more connections, fragile mirrors need less
+        self.use_adaptive_threads()
+
         # we register the stop() method of SmartDL to be called when the program exits
         # it makes sure any downloading threads are safely terminated
         import atexit
@@ -56,20 +79,24 @@ class Downloader(SmartDL):
         pass  # only needed for aria2
 
 
-def download_kano_os(report_progress_ui, get_downloader):
+def download_kano_os(report_progress_ui, get_downloader, rate_limit=DOWNLOAD_RATE_LIMIT, cancelled=None):
     '''
     This method is used by the backendThread to download Kano OS.
 
     We start PySmartDL as a child process and then sit in a polling loop
     to report progress to the UI. We will also return the OS info dict
     along with any error that might have occured.
+
+    The download speed is capped to rate_limit KB/s, if it is positive.
+    The download is stopped if the cancelled event is set.
     '''
 
     # set the progress to 0% on the UI progressbar, and write what we're up to
     report_progress_ui(0, 'preparing to download OS image..')
 
     # get information about the latest OS version e.g. url, filename, md5 checksum
-    os_info = get_latest_os_info()
+    with span('metadata'):
+        os_info = get_latest_os_info()
     if not os_info:
         return None, DOWNLOAD_ERROR
 
@@ -84,6 +111,9 @@ def download_kano_os(report_progress_ui, get_downloader):
         downloader = get_downloader(os_info['url'], dest=temp_path, progress_bar=False)
         # simply make sure the file was not corrupted - not for cryptographic security
         downloader.add_hash_verification('md5', os_info['compressed_md5'])
+        if rate_limit > 0:
+            debugger('Limiting download speed to {} KB/s'.format(rate_limit))
+            downloader.limit_speed(rate_limit)
         downloader.start(blocking=False)
 
     except KeyError:
@@ -97,12 +127,33 @@ def download_kano_os(report_progress_ui, get_downloader):
 
     # the downloader is running separate threads so here we wait for the
     # process to finish and call the UI function which reports the process
-    while not downloader.isFinished():
-        report_progress_ui(downloader.get_progress() * 100, 'speed {}  eta {}  completed {}%'
-                           .format(downloader.get_speed(human=True),
-                                   downloader.get_eta(human=True),
-                                   int(downloader.get_progress() * 100)))
-        time.sleep(0.3)
+    # the bytes are counted from what the downloader actually transferred, such that
+    # a file which was already downloaded is not counted again
+    counted_bytes = 0
+    with span('transfer', url=os_info['url']):
+        while not downloader.isFinished():
+            if cancelled and cancelled.is_set():
+                debugger('Downloading cancelled')
+                count_downloaded_bytes(downloader, counted_bytes)
+                # PySmartDL is stopped, aria2 has to be shut down
+                getattr(downloader, 'stop', downloader.close)()
+                return None, CANCELLED_ERROR
+
+            progress = downloader.get_progress()
+            report_progress_ui(progress * 100, 'speed {}  eta {}  completed {}%'
+                               .format(downloader.get_speed(human=True),
+                                       downloader.get_eta(human=True),
+                                       int(progress * 100)))
+
+            counted_bytes = count_downloaded_bytes(downloader, counted_bytes)
+            time.sleep(0.3)
+
+    count_downloaded_bytes(downloader, counted_bytes)
+
+    # PySmartDL checks the md5 as part of the download, aria2 does not tell
+    hash_time = getattr(downloader, 'get_hash_time', lambda: None)()
+    if hash_time is not None:
+        add_span('hash', time.time() - hash_time, hash_time)
 
     # check if the download finished successfully
     if downloader.isSuccessful():
@@ -126,21 +177,28 @@ def download_kano_os(report_progress_ui, get_downloader):
         return None, DOWNLOAD_ERROR
 
 
+def count_downloaded_bytes(downloader, counted_bytes):
+    # adds the bytes transferred since they were last counted, returns the new total
+    dl_size = downloader.get_dl_size()
+    if dl_size > counted_bytes:
+        downloaded_bytes.inc(dl_size - counted_bytes)
+        return dl_size
+    return counted_bytes
+
+
 def get_latest_os_info():
     debugger("Downloading latest OS information")
 
-    # we put everything in a try block as urlopen raises URLError
+    # we put everything in a try block as fetching raises URLError
+    # when there is no cached copy to fall back to
     try:
         # get latest.json from download.kano.me
-        response = urllib2.urlopen(LATEST_OS_INFO_URL)
-        latest_json = json.load(response)
+        latest_json = fetch_json(LATEST_OS_INFO_URL)
 
         # the .gz archive will be used on all OSs
         latest_json['archive'] = latest_json['filename'] + '.gz'
 
-        # give the server some time to breathe between requests
         debugger('Latest Kano OS image is {}'.format(latest_json['filename']))
-        time.sleep(1)
 
         # use the url for the latest os version to get info about the image
         latest_image_json = '{base_url}{filename}.json'.format(
@@ -153,11 +211,7 @@ def get_latest_os_info():
             latest_json['url'] = latest_json['url.v2']
 
         debugger('Latest Kano OS image json is {}'.format(latest_image_json))
-        response = urllib2.urlopen(latest_image_json)
-        os_json = json.load(response)
-
-        # give the server some time to breathe between requests
-        time.sleep(1)
+        os_json = fetch_json(latest_image_json)
 
     except:
         debugger('[ERROR] Downloading OS info failed')
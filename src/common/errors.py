@@ -55,7 +55,23 @@ FORMAT_ERROR = {
     'title': 'There was an error formatting the disk..',
     'description': 'Maybe it is write protected?'
 }
+WIPE_ERROR = {
+    'title': 'There was an error wiping the disk..',
+    'description': 'Maybe it is write protected?'
+}
+VERIFY_ERROR = {
+    'title': 'Kano OS was not burned correctly..',
+    'description': 'The SD card may be faulty, please try another one'
+}
 EJECT_ERROR = {
     'title': 'There was an error ejecting the disk..',
     'description': 'Please eject it manually.'
 }
+CANCELLED_ERROR = {
+    'title': 'The burning process was cancelled..',
+    'description': 'Please try again'
+}
+UNEXPECTED_ERROR = {
+    'title': 'Something went wrong..',
+    'description': 'Please try again, and send us the logs if it keeps happening'
+}
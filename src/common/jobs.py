@@ -0,0 +1,246 @@
+#!/usr/bin/env python
+
+# jobs.py
+#
+# Copyright (C) 2015 Kano Computing Ltd.
+# License: http://www.gnu.org/licenses/gpl-2.0.txt GNU General Public License v2
+#
+#
+# Scheduling downloading, burning and verifying jobs
+#
+# Every step of the burning process is a Job which runs in one of a few pools of
+# worker threads, depending on what it mostly waits for: the network, decompressing
+# the image or writing to a disk. A slow download therefore cannot hold up the burns
+# and several disks can be burned and verified at the same time.
+#
+# A job can depend on other jobs, e.g. burning depends on the image being downloaded,
+# and only starts once they all finished successfully. If one of them fails, the job
+# fails with the same error without running. Jobs using the same disk never run at
+# the same time, such that a disk is not verified while it is still being burned.
+#
+# Jobs can be cancelled. A pending job is simply dropped, a running one is asked
+# to stop by its cancelled event, which long running functions should check.
+
+
+import time
+import threading
+import traceback
+
+from src.common.utils import debugger
+from src.common.logger import set_log_stage
+from src.common.trace import span, get_trace, activate
+from src.common.metrics import record_stage
+from src.common.errors import CANCELLED_ERROR, UNEXPECTED_ERROR
+
+
+# The number of worker threads of each pool, i.e. how many jobs run at the same time
+POOL_SIZES = {
+    'network': 1,
+    'decompress': 2,
+    'device': 4
+}
+
+# How many jobs may use the same disk at the same time
+DEVICE_LIMIT = 1
+
+# Job states
+PENDING = 'pending'
+RUNNING = 'running'
+FINISHED = 'finished'
+CANCELLED = 'cancelled'
+
+
+class Job(object):
+    '''
+    A single step to be run by the Scheduler in the given pool.
+
+    The function is called with the job itself, such that it can read the results
+    of the jobs it depends on and check whether it was cancelled, and returns
+    a (result, error) tuple, like download_kano_os() does.
+
+    The job is timed in the given trace, or else in the trace of the thread
+    which created it, if any.
+    '''
+
+    def __init__(self, name, function, pool, device=None, depends=None, trace=None):
+        self.name = name
+        self.function = function
+        self.pool = pool
+        self.device = device
+        self.depends = list(depends or [])
+        self.trace = trace or get_trace()
+
+        self.state = PENDING
+        self.result = None
+        self.error = None
+        self.duration = None
+
+        self.cancelled = threading.Event()
+        self.done = threading.Event()
+
+    def cancel(self):
+        self.cancelled.set()
+
+    def wait(self, timeout=None):
+        # returns True if the job is done, successfully or not
+        # waiting in short steps, as Python 2 cannot interrupt Event.wait() with Ctrl+C
+        deadline = time.time() + timeout if timeout is not None else None
+        while not self.done.is_set():
+            if deadline is not None and time.time() >= deadline:
+                break
+            self.done.wait(0.2)
+        return self.done.is_set()
+
+    def isSuccessful(self):
+        return self.state == FINISHED and not self.error
+
+    def __repr__(self):
+        return '<Job {} {}>'.format(self.name, self.state)
+
+
+class Scheduler(object):
+    '''
+    This class runs the submitted jobs in pools of daemon worker threads,
+    honouring their dependencies and the limit of jobs per disk.
+    '''
+
+    def __init__(self, pools=POOL_SIZES, device_limit=DEVICE_LIMIT):
+        self.device_limit = device_limit
+        self.condition = threading.Condition()
+        self.pending = list()
+        self.running = list()
+        self.devices = dict()  # the number of jobs running on each disk
+        self.stopped = False
+
+        self.workers = list()
+        for pool, size in pools.items():
+            for index in range(size):
+                worker = threading.Thread(target=self.work, args=(pool,),
+                                          name='{}-{}'.format(pool, index))
+                worker.daemon = True
+                worker.start()
+                self.workers.append(worker)
+
+    def submit(self, job):
+        with self.condition:
+            if self.stopped:
+                self.finish(job, CANCELLED, None, CANCELLED_ERROR)
+            else:
+                self.pending.append(job)
+                self.condition.notify_all()
+        return job
+
+    def cancel(self, job):
+        job.cancel()
+
+        # a pending job is dropped straight away, its dependent jobs are then
+        # dropped by the workers, a running job has to stop by itself
+        with self.condition:
+            if job in self.pending:
+                self.pending.remove(job)
+                self.finish(job, CANCELLED, None, CANCELLED_ERROR)
+
+    def stop(self):
+        '''
+        This method cancels all the pending and running jobs, and stops the workers
+        once they are done. Jobs which ignore their cancelled event keep running.
+        '''
+
+        with self.condition:
+            self.stopped = True
+            for job in self.running:
+                job.cancel()
+            for job in self.pending:
+                job.cancel()
+                self.finish(job, CANCELLED, None, CANCELLED_ERROR)
+            self.pending = list()
+            self.condition.notify_all()
+
+    def work(self, pool):
+        while True:
+            with self.condition:
+                job = self.next_job(pool)
+                while not job and not self.stopped:
+                    self.condition.wait()
+                    job = self.next_job(pool)
+
+                if not job:
+                    return
+
+                self.pending.remove(job)
+                self.running.append(job)
+                job.state = RUNNING
+                if job.device is not None:
+                    self.devices[job.device] = self.devices.get(job.device, 0) + 1
+
+            self.run(job)
+
+            with self.condition:
+                self.running.remove(job)
+                if job.device is not None:
+                    self.devices[job.device] -= 1
+                self.condition.notify_all()
+
+    def next_job(self, pool):
+        '''
+        This method returns the first pending job of the pool which can run now,
+        dropping the ones which were cancelled or whose dependencies failed.
+        It is called with the condition held.
+        '''
+
+        for job in list(self.pending):
+            failed = [dependency for dependency in job.depends
+                      if dependency.done.is_set() and not dependency.isSuccessful()]
+
+            if job.cancelled.is_set():
+                self.pending.remove(job)
+                self.finish(job, CANCELLED, None, CANCELLED_ERROR)
+            elif failed:
+                self.pending.remove(job)
+                self.finish(job, CANCELLED, None, failed[0].error or CANCELLED_ERROR)
+            elif job.pool != pool:
+                continue
+            elif not all(dependency.done.is_set() for dependency in job.depends):
+                continue
+            elif job.device is not None and self.devices.get(job.device, 0) >= self.device_limit:
+                continue
+            else:
+                return job
+
+        return None
+
+    def run(self, job):
+        set_log_stage(job.name)
+        activate(job.trace)
+        debugger('Starting job {}'.format(job.name))
+        start = time.time()
+        result, error = None, None
+
+        try:
+            with span(job.name.split()[0], job=job.name):
+                result, error = job.function(job)
+        except Exception as e:
+            debugger('[ERROR] Job {} crashed: {}'.format(job.name, e))
+            debugger(traceback.format_exc())
+            error = UNEXPECTED_ERROR
+
+        # a job which stopped because it was cancelled did not fail on its own
+        if job.cancelled.is_set() and error:
+            state, error = CANCELLED, CANCELLED_ERROR
+        else:
+            state = FINISHED
+
+        job.duration = time.time() - start
+        record_stage(job.name.split()[0], job.device, job.duration, error if state == FINISHED else None)
+        debugger('Job {} {} in {:.2f}s{}'.format(job.name, state, job.duration,
+                                                   ' with error: ' + error['title'] if error else ''))
+        with self.condition:
+            self.finish(job, state, result, error)
+
+    def finish(self, job, state, result, error):
+        # called with the condition held, the dependent jobs are re-examined by the workers
+        job.state = state
+        job.result = result
+        job.error = error
+        job.done.set()
+        self.condition.notify_all()
@@ -0,0 +1,152 @@
+#!/usr/bin/env python
+
+# log_upload.py
+#
+# Copyright (C) 2015 Kano Computing Ltd.
+# License: http://www.gnu.org/licenses/gpl-2.0.txt GNU General Public License v2
+#
+#
+# Uploading log reports in the background
+#
+# A log report is offered when the application is closing, so we cannot wait for it
+# to be uploaded. The report is compressed and saved to an outbox folder first, then
+# a background thread uploads it with a timeout and a few retries, and deletes it once
+# it is sent. The feedback server takes plain form posts, so the report is only kept
+# compressed on disk and is sent uncompressed. A report which could not be sent,
+# e.g. without internet or because the application was closed in the meantime,
+# stays in the outbox and is uploaded the next time the application is launched.
+
+
+import os
+import time
+import gzip
+import platform
+import threading
+from urllib import urlencode
+from urllib2 import Request, urlopen, URLError, HTTPError
+
+from src.common.utils import debugger, make_dir, FEEDBACK_URL, BURNER_VERSION
+from src.common.paths import outbox_path
+
+
+# How long a single upload may take, in seconds
+UPLOAD_TIMEOUT = 15
+
+# How many times an upload is tried, waiting twice as long before each retry
+UPLOAD_ATTEMPTS = 3
+UPLOAD_RETRY_DELAY = 2
+
+# only one uploader runs at a time, see upload_queued_logs()
+uploader_lock = threading.Lock()
+
+
+def submit_log(log, email):
+    '''
+    This method queues the log report in the outbox and uploads it in the
+    background. It returns straight away, the upload may finish later.
+    '''
+
+    payload = {
+        "text": log,
+        "email": email,
+        "username": "NotApplicable",
+        "category": "Burner",
+        "subject": "Burner failure in version {} on {}".format(BURNER_VERSION, platform.version())
+    }
+
+    try:
+        queue_report(urlencode(payload))
+    except (IOError, OSError) as e:
+        debugger('[ERROR] Saving the log report failed: {}'.format(e))
+        return
+
+    upload_queued_logs()
+
+
+def queue_report(data):
+    make_dir(outbox_path)
+
+    # the file is renamed once written, such that a half written report is never sent
+    path = os.path.join(outbox_path, '{:.3f}.gz'.format(time.time()))
+    with gzip.open(path + '.part', 'wb') as report_file:
+        report_file.write(data)
+    os.rename(path + '.part', path)
+
+    debugger('Log report of {} KB queued as {}'.format(len(data) / 1000, path))
+
+
+def upload_queued_logs():
+    '''
+    This method starts uploading the reports in the outbox in a daemon thread,
+    such that exiting the application never waits for the network.
+    '''
+
+    if not os.path.isdir(outbox_path):
+        return
+
+    uploader = threading.Thread(target=upload_reports)
+    uploader.daemon = True
+    uploader.start()
+
+
+def upload_reports():
+    if not uploader_lock.acquire(False):
+        return  # another uploader is already running and will pick up new reports
+
+    try:
+        while True:
+            reports = sorted(name for name in os.listdir(outbox_path) if name.endswith('.gz'))
+            if not reports:
+                return
+
+            # keep the reports for the next launch if the first one cannot be sent
+            path = os.path.join(outbox_path, reports[0])
+            if not upload_report(path):
+                return
+            os.remove(path)
+
+    except (IOError, OSError) as e:
+        debugger('[ERROR] Uploading log reports failed: {}'.format(e))
+    finally:
+        uploader_lock.release()
+
+
+def upload_report(path):
+    '''
+    This method sends the report to the feedback server and returns
+    whether it is done with, i.e. it was sent or the server refused it.
+    '''
+
+    with gzip.open(path, 'rb') as report_file:
+        data = report_file.read()
+
+    delay = UPLOAD_RETRY_DELAY
+    for attempt in range(1, UPLOAD_ATTEMPTS + 1):
+        try:
+            start = time.time()
+            content = send(data)
+            debugger('Log report of {} KB sent in {:.2f}s: {}'
+                     .format(len(data) / 1000, time.time() - start, content))
+            return True
+
+        except HTTPError as e:
+            # sending it again would not help, the report is dropped
+            if e.code < 500:
+                debugger('[ERROR] The server refused the log report, dropping it: {}'.format(e))
+                return True
+            debugger('[ERROR] Sending the log report failed, attempt {}: {}'.format(attempt, e))
+
+        except (URLError, IOError) as e:
+            debugger('[ERROR] Sending the log report failed, attempt {}: {}'.format(attempt, e))
+
+        if attempt < UPLOAD_ATTEMPTS:
+            time.sleep(delay)
+            delay *= 2
+
+    return False
+
+
+def send(data):
+    headers = {'Content-Type': 'application/x-www-form-urlencoded'}
+    request = Request(FEEDBACK_URL, data, headers)
+    return urlopen(request, timeout=UPLOAD_TIMEOUT).read()
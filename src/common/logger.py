@@ -0,0 +1,235 @@
+#!/usr/bin/env python
+
+# logger.py
+#
+# Copyright (C) 2015 Kano Computing Ltd.
+# License: http://www.gnu.org/licenses/gpl-2.0.txt GNU General Public License v2
+#
+#
+# Writing the debug log in the background
+#
+# The debugger is called from polling loops several times a second, so instead of
+# opening the log file for every line, the lines are put on a bounded queue and a
+# background thread appends them to the file in batches. The file is only open
+# while a batch is written, such that the temp folder can still be deleted.
+#
+# The log is flushed periodically, and straight away on errors, before it is read
+# for a report and when the application exits. If the writer falls behind, the
+# callers wait for it rather than lines being dropped.
+#
+# Every line is a record with a timestamp, a level and the stage it was logged in,
+#    2015-06-01 12:00:00.123 ERROR [burn] [ERROR] Burning Kano image failed
+# Once the file reaches LOG_MAX_SIZE, it is rotated to debug.txt.1 and so on, such
+# that long station sessions do not fill the disk. When a log report is sent, only
+# the records of the last failed burn are extracted, without those of other disks.
+
+
+import os
+import re
+import time
+import Queue
+import atexit
+import threading
+
+
+# The maximum number of lines waiting to be written
+LOG_QUEUE_SIZE = 10000
+
+# How often the lines waiting are written to the file, in seconds
+LOG_FLUSH_INTERVAL = 1
+
+# The most lines written at once
+LOG_BATCH_SIZE = 1000
+
+# The size at which the log file is rotated, and how many old files are kept
+LOG_MAX_SIZE = 1000000
+LOG_BACKUPS = 2
+
+# The maximum size of the log extracted for a report, the most recent records are kept
+LOG_REPORT_SIZE = 200000
+
+# The message logged when a burn starts, the failure log is extracted from there
+BURN_START = 'Starting the burning process'
+
+# e.g. 2015-06-01 12:00:00.123 INFO [download] Latest Kano OS image is ...
+RECORD_PATTERN = re.compile(r'^(\d{4}-\d\d-\d\d \d\d:\d\d:\d\d\.\d{3}) (\w+) \[(.*?)\] (.*)$')
+
+# the stage of each thread, the threads which never set one log with the default
+log_context = threading.local()
+default_stage = 'main'
+
+
+class LogWriter(threading.Thread):
+    '''
+    This daemon thread appends the lines given to write() to the log file.
+    '''
+
+    def __init__(self, path, queue_size=LOG_QUEUE_SIZE, flush_interval=LOG_FLUSH_INTERVAL,
+                 max_size=LOG_MAX_SIZE, backups=LOG_BACKUPS):
+        super(LogWriter, self).__init__()
+        self.daemon = True
+
+        self.path = path
+        self.max_size = max_size
+        self.backups = backups
+        self.flush_interval = flush_interval
+        self.lines = Queue.Queue(queue_size)
+
+        # write() may be called by several threads, the file is only written here
+        self.start()
+        atexit.register(self.flush)
+
+    def write(self, line):
+        self.lines.put(line)
+
+    def flush(self):
+        # waits until every line written so far is in the file
+        if self.is_alive():
+            done = threading.Event()
+            self.lines.put(done)
+            done.wait(self.flush_interval * 5)
+
+    def run(self):
+        while True:
+            batch = list()
+            flushes = list()
+
+            # wait for a line, then gather the lines coming in during the flush
+            # interval, unless a flush is requested or the batch is big enough
+            item = self.lines.get()
+            deadline = time.time() + self.flush_interval
+            while True:
+                if isinstance(item, basestring):
+                    batch.append(item)
+                else:
+                    flushes.append(item)
+                    break
+
+                remaining = deadline - time.time()
+                if remaining <= 0 or len(batch) >= LOG_BATCH_SIZE:
+                    break
+                try:
+                    item = self.lines.get(timeout=remaining)
+                except Queue.Empty:
+                    break
+
+            if batch:
+                self.write_batch(batch)
+            for done in flushes:
+                done.set()
+
+    def write_batch(self, batch):
+        try:
+            with open(self.path, 'a') as log_file:
+                for line in batch:
+                    log_file.write(line + '\n')
+                size = log_file.tell()
+
+            # e.g. /dev/tty is never rotated
+            if size >= self.max_size and os.path.isfile(self.path):
+                self.rotate()
+        except (IOError, OSError):
+            pass  # e.g. the temp folder has been deleted while closing
+
+    def rotate(self):
+        # debug.txt.1 becomes debug.txt.2 and so on, the oldest one is removed
+        for index in range(self.backups, 0, -1):
+            source = '{}.{}'.format(self.path, index - 1) if index > 1 else self.path
+            target = '{}.{}'.format(self.path, index)
+            if os.path.exists(source):
+                # renaming over an existing file fails on Windows
+                if os.path.exists(target):
+                    os.remove(target)
+                os.rename(source, target)
+
+
+def set_log_stage(stage):
+    # only for the calling thread, e.g. a job must not relabel the other burns
+    log_context.stage = stage
+
+
+def format_record(text):
+    now = time.time()
+    level = 'ERROR' if text.startswith('[ERROR]') else 'INFO'
+    stage = getattr(log_context, 'stage', None) or default_stage
+
+    timestamp = '{}.{:03d}'.format(time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(now)),
+                                   int(now % 1 * 1000))
+    return '{} {} [{}] {}'.format(timestamp, level, stage, text)
+
+
+def read_records(path, backups=LOG_BACKUPS):
+    '''
+    This method returns the records of the log file and its rotated files,
+    the oldest first, as dicts with the time, level, stage and text.
+    '''
+
+    records = list()
+    paths = ['{}.{}'.format(path, index) for index in range(backups, 0, -1)] + [path]
+    for log_path in [log_path for log_path in paths if os.path.isfile(log_path)]:
+        with open(log_path) as log_file:
+            for line in log_file:
+                match = RECORD_PATTERN.match(line.rstrip('\n'))
+                if match:
+                    time_text, level, stage, text = match.groups()
+                    records.append({'time': time_text, 'level': level, 'stage': stage, 'text': text})
+                elif records:
+                    # multiline messages, e.g. tracebacks, belong to the record before
+                    records[-1]['text'] += '\n' + line.rstrip('\n')
+
+    return records
+
+
+def get_stage_device(stage):
+    # the jobs of a disk are named after it, e.g. 'burn /dev/sdb', the shared ones are not
+    parts = stage.split(' ', 1)
+    return parts[1] if len(parts) > 1 else None
+
+
+def extract_failure_log(path, max_size=LOG_REPORT_SIZE):
+    '''
+    This method returns the records of the last burn which failed as text,
+    from the start of that burn up to the start of the next one on the same disk,
+    such that the traceback and the records after the error are included.
+    The records of other disks burned at the same time are left out.
+    Without any errors, the most recent records are returned.
+    The text is at most max_size long.
+    '''
+
+    records = read_records(path)
+
+    errors = [index for index, record in enumerate(records) if record['level'] == 'ERROR']
+    last = errors[-1] if errors else len(records) - 1
+    device = get_stage_device(records[last]['stage']) if errors else None
+
+    def is_burn_start(record):
+        # e.g. 'Starting the burning process on /dev/sdb'
+        return record['text'].startswith(BURN_START) and \
+            (device is None or record['text'].endswith(' on {}'.format(device)))
+
+    def is_selected(record):
+        if device is None:
+            return True
+        if record['text'].startswith(BURN_START):
+            return is_burn_start(record)
+        stage_device = get_stage_device(record['stage'])
+        return stage_device is None or stage_device == device
+
+    starts = [index for index in range(last + 1) if is_burn_start(records[index])]
+    start = starts[-1] if starts else 0
+    ends = [index for index in range(last + 1, len(records)) if is_burn_start(records[index])]
+    end = ends[0] if ends else len(records)
+
+    selected = [record for record in records[start:end] if is_selected(record)]
+
+    # keep the most recent records which fit in max_size
+    lines = list()
+    size = 0
+    for record in reversed(selected):
+        line = '{time} {level} [{stage}] {text}'.format(**record)
+        size += len(line) + 1
+        if size > max_size:
+            break
+        lines.append(line)
+
+    return '\n'.join(reversed(lines))
@@ -0,0 +1,111 @@
+#!/usr/bin/env python
+
+# metadata_cache.py
+#
+# Copyright (C) 2015 Kano Computing Ltd.
+# License: http://www.gnu.org/licenses/gpl-2.0.txt GNU General Public License v2
+#
+#
+# Cached fetching of the OS information JSON files
+#
+# The JSON files describing the latest OS release are needed both when checking
+# for dependencies and when downloading. We keep the last good copy of each on disk,
+# reuse it for a few minutes without asking the server, and after that only revalidate
+# it with ETag / If-Modified-Since. If the server cannot be reached, we fall back
+# to the last good copy, however old it is.
+
+
+import os
+import json
+import time
+import hashlib
+
+from src.common.pySmartDL import connectionpool
+from src.common.utils import debugger, make_dir, read_file_contents, write_file_contents
+from src.common.paths import cache_path
+from src.common.metrics import record_metadata_request
+
+
+# How long a cached copy is used without asking the server, in seconds
+METADATA_TTL = 10 * 60
+
+# Timeout for the metadata requests, in seconds
+METADATA_TIMEOUT = 10
+
+
+def fetch_json(url, ttl=METADATA_TTL):
+    '''
+    This method returns the parsed JSON found at the given url.
+
+    A copy younger than ttl seconds is returned straight from the cache. Otherwise, we
+    revalidate it with the server and only download it again if it has changed.
+    Raises the network or parsing error if there is no cached copy to fall back to.
+    '''
+
+    entry_path = os.path.join(cache_path, hashlib.md5(url).hexdigest() + '.json')
+    entry = read_cache_entry(entry_path)
+
+    if entry and time.time() - entry['fetched'] < ttl:
+        debugger('Using cached {}'.format(url))
+        record_metadata_request('hit')
+        return json.loads(entry['data'])
+
+    headers = {}
+    if entry and entry.get('etag'):
+        headers['If-None-Match'] = entry['etag']
+    if entry and entry.get('last_modified'):
+        headers['If-Modified-Since'] = entry['last_modified']
+
+    try:
+        response = connectionpool.urlopen(url, headers=headers, timeout=METADATA_TIMEOUT)
+        try:
+            if response.getcode() == 304 and entry:
+                debugger('Cached {} is still valid'.format(url))
+                record_metadata_request('revalidated')
+                data = entry['data']
+            else:
+                data = response.read()
+                json.loads(data)  # make sure we never cache a broken file
+                entry = {
+                    'url': url,
+                    'etag': response.headers.getheader('ETag'),
+                    'last_modified': response.headers.getheader('Last-Modified')
+                }
+                record_metadata_request('fetched')
+        finally:
+            response.close()
+
+    except Exception as e:
+        if not entry:
+            raise
+        debugger('[ERROR] Fetching {} failed ({}), using the copy from {}'
+                 .format(url, e, time.ctime(entry['fetched'])))
+        record_metadata_request('stale')
+        return json.loads(entry['data'])
+
+    entry['data'] = data
+    entry['fetched'] = time.time()
+    write_cache_entry(entry_path, entry)
+
+    return json.loads(data)
+
+
+def read_cache_entry(path):
+    # a truncated entry, or one written by an older version, is treated as missing
+    try:
+        entry = json.loads(read_file_contents(path))
+        if not isinstance(entry, dict) or not isinstance(entry.get('fetched'), (int, float)):
+            return None
+        json.loads(entry['data'])
+        return entry
+    except:
+        return None
+
+
+def write_cache_entry(path, entry):
+    # the cache is only an optimisation, failing to write it is not an error
+    try:
+        make_dir(os.path.dirname(path))
+        write_file_contents(json.dumps(entry), path)
+    except Exception as e:
+        debugger('[ERROR] Writing metadata cache failed: {}'.format(e))
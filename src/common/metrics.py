@@ -0,0 +1,234 @@
+#!/usr/bin/env python
+
+# metrics.py
+#
+# Copyright (C) 2015 Kano Computing Ltd.
+# License: http://www.gnu.org/licenses/gpl-2.0.txt GNU General Public License v2
+#
+#
+# Exporting metrics for monitoring burn stations
+#
+# The download and burn loops update a few counters and histograms in memory, e.g.
+# the bytes downloaded, the metadata cache hits, the burn speeds and the errors of
+# every disk. When enabled, they are exported in the Prometheus text format,
+#    KANO_BURNER_METRICS_FILE=/var/lib/node_exporter/kano-burner.prom
+#        rewrites the file every few seconds, e.g. for the node_exporter textfile collector
+#    KANO_BURNER_METRICS_PORT=9471
+#        serves them on http://127.0.0.1:9471/metrics
+# Both work without any other service, the metrics are simply lost on exit.
+
+
+import os
+import time
+import atexit
+import threading
+import BaseHTTPServer
+
+from src.common.utils import debugger, BYTES_IN_MEGABYTE, METRICS_FILE, METRICS_PORT
+
+
+# How often the metrics file is rewritten, in seconds
+METRICS_INTERVAL = 10
+
+# The buckets of the histograms, the last one is always +Inf
+DURATION_BUCKETS = [1, 5, 15, 30, 60, 120, 300, 600, 1200, 1800, 3600]
+THROUGHPUT_BUCKETS = [1, 2, 5, 10, 15, 20, 30, 50, 100]
+
+
+class Counter(object):
+    '''
+    A value which only goes up, for every combination of labels.
+    '''
+
+    kind = 'counter'
+
+    def __init__(self, name, help_text):
+        self.name = name
+        self.help_text = help_text
+        self.values = dict()
+        self.lock = threading.Lock()
+
+    def inc(self, amount=1, **labels):
+        key = tuple(sorted(labels.items()))
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+    def get(self, **labels):
+        with self.lock:
+            return self.values.get(tuple(sorted(labels.items())), 0)
+
+    def render(self):
+        lines = ['# HELP {} {}'.format(self.name, self.help_text),
+                 '# TYPE {} {}'.format(self.name, self.kind)]
+        with self.lock:
+            for key, value in sorted(self.values.items()):
+                lines.append('{}{} {}'.format(self.name, format_labels(key), value))
+        return lines
+
+
+class Histogram(object):
+    '''
+    The distribution of observed values in cumulative buckets, for every combination of labels.
+    '''
+
+    def __init__(self, name, help_text, buckets):
+        self.name = name
+        self.help_text = help_text
+        self.buckets = buckets
+        self.values = dict()  # labels -> [bucket counts, sum, count]
+        self.lock = threading.Lock()
+
+    def observe(self, value, **labels):
+        key = tuple(sorted(labels.items()))
+        with self.lock:
+            counts, total, count = self.values.get(key, ([0] * len(self.buckets), 0, 0))
+            counts = [bucket_count + (value <= bound) for bucket_count, bound in zip(counts, self.buckets)]
+            self.values[key] = (counts, total + value, count + 1)
+
+    def render(self):
+        lines = ['# HELP {} {}'.format(self.name, self.help_text),
+                 '# TYPE {} histogram'.format(self.name)]
+        with self.lock:
+            for key, (counts, total, count) in sorted(self.values.items()):
+                for bound, bucket_count in zip(self.buckets, counts):
+                    lines.append('{}_bucket{} {}'.format(self.name, format_labels(key + (('le', bound),)),
+                                                         bucket_count))
+                lines.append('{}_bucket{} {}'.format(self.name, format_labels(key + (('le', '+Inf'),)), count))
+                lines.append('{}_sum{} {}'.format(self.name, format_labels(key), round(total, 3)))
+                lines.append('{}_count{} {}'.format(self.name, format_labels(key), count))
+        return lines
+
+
+class Gauge(Counter):
+    '''
+    A value which is set rather than counted, for every combination of labels.
+    '''
+
+    kind = 'gauge'
+
+    def set(self, value, **labels):
+        with self.lock:
+            self.values[tuple(sorted(labels.items()))] = value
+
+
+def format_labels(key):
+    if not key:
+        return ''
+    labels = ['{}="{}"'.format(name, str(value).replace('\\', '\\\\').replace('"', '\\"'))
+              for name, value in key]
+    return '{' + ','.join(labels) + '}'
+
+
+downloaded_bytes = Counter('kano_burner_downloaded_bytes_total',
+                           'Bytes of Kano OS images downloaded.')
+metadata_requests = Counter('kano_burner_metadata_requests_total',
+                            'OS information requests by how they were answered: hit, revalidated, fetched or stale.')
+metadata_hit_ratio = Gauge('kano_burner_metadata_cache_hit_ratio',
+                           'Share of OS information requests answered without a download.')
+burns = Counter('kano_burner_burns_total',
+                'Burns by disk and result: success or the stage which failed.')
+stage_errors = Counter('kano_burner_stage_errors_total',
+                       'Failed steps by stage and disk.')
+stage_duration = Histogram('kano_burner_stage_duration_seconds',
+                           'Time taken by the steps of the burns.', DURATION_BUCKETS)
+burn_throughput = Histogram('kano_burner_burn_throughput_megabytes_per_second',
+                            'Speed at which images were written to the disks.', THROUGHPUT_BUCKETS)
+
+all_metrics = [downloaded_bytes, metadata_requests, metadata_hit_ratio, burns,
+               stage_errors, stage_duration, burn_throughput]
+
+
+def record_metadata_request(result):
+    metadata_requests.inc(result=result)
+
+    # the cache answered unless the file had to be downloaded again
+    requests = sum(metadata_requests.get(result=name) for name in ['hit', 'revalidated', 'fetched', 'stale'])
+    hits = requests - metadata_requests.get(result='fetched')
+    metadata_hit_ratio.set(round(float(hits) / requests, 3))
+
+
+def record_stage(stage, device, duration, error):
+    stage_duration.observe(duration, stage=stage)
+    if error:
+        stage_errors.inc(stage=stage, device=device or '')
+
+
+def record_burn(device, result):
+    burns.inc(device=device, result=result)
+
+
+def record_burn_speed(size, duration):
+    # in MB/s, like the speed shown while burning
+    if duration > 0:
+        burn_throughput.observe(size / duration / BYTES_IN_MEGABYTE)
+
+
+def render():
+    lines = list()
+    for metric in all_metrics:
+        lines.extend(metric.render())
+    return '\n'.join(lines) + '\n'
+
+
+def write_metrics_file(path):
+    # written to a temporary file first, such that a reader never sees half of it
+    try:
+        with open(path + '.tmp', 'w') as metrics_file:
+            metrics_file.write(render())
+        if os.path.exists(path) and os.name == 'nt':
+            os.remove(path)
+        os.rename(path + '.tmp', path)
+    except (IOError, OSError) as e:
+        debugger('[ERROR] Writing the metrics to {} failed: {}'.format(path, e))
+
+
+class MetricsHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    '''
+    This request handler serves the metrics on /metrics.
+    '''
+
+    def do_GET(self):
+        if self.path.split('?')[0] not in ['/', '/metrics']:
+            self.send_error(404)
+            return
+
+        body = render()
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass  # the scrapes would flood the debug log
+
+
+def start_metrics_export(metrics_file=METRICS_FILE, port=METRICS_PORT):
+    '''
+    This method starts exporting the metrics to the file and on the port
+    which were configured, in daemon threads. It does nothing by default.
+    '''
+
+    if metrics_file:
+        def write_periodically():
+            while True:
+                write_metrics_file(metrics_file)
+                time.sleep(METRICS_INTERVAL)
+
+        writer = threading.Thread(target=write_periodically)
+        writer.daemon = True
+        writer.start()
+        atexit.register(write_metrics_file, metrics_file)
+        debugger('Writing metrics to {}'.format(metrics_file))
+
+    if port:
+        try:
+            server = BaseHTTPServer.HTTPServer(('127.0.0.1', port), MetricsHandler)
+        except Exception as e:
+            debugger('[ERROR] Serving the metrics on port {} failed: {}'.format(port, e))
+            return
+
+        server_thread = threading.Thread(target=server.serve_forever)
+        server_thread.daemon = True
+        server_thread.start()
+        debugger('Serving metrics on http://127.0.0.1:{}/metrics'.format(port))
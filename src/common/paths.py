@@ -31,6 +31,15 @@ temp_path = os.path.join(base_path, 'temp')
 if not os.path.exists(temp_path):
         os.makedirs(temp_path)
 
+# setting a Cache directory path, unlike Temp it is kept between runs
+cache_path = os.path.join(os.path.expanduser('~'), '.kano-burner', 'cache')
+
+# setting an Outbox directory path for the log reports which are still to be sent
+outbox_path = os.path.join(os.path.expanduser('~'), '.kano-burner', 'outbox')
+
+# setting a Traces directory path for the timing reports of the burns
+traces_path = os.path.join(os.path.expanduser('~'), '.kano-burner', 'traces')
+
 # setting Resources paths - css and images
 res_path = os.path.join(base_path, 'res')
 images_path = os.path.join(res_path, 'images')
@@ -0,0 +1,86 @@
+#!/usr/bin/env python
+
+# prefetch.py
+#
+# Copyright (C) 2015 Kano Computing Ltd.
+# License: http://www.gnu.org/licenses/gpl-2.0.txt GNU General Public License v2
+#
+#
+# Downloading the image while the user is choosing a disk
+#
+# When enabled with KANO_BURNER_PREFETCH=1, the image starts downloading as soon as
+# the dependency checks pass. Until the user clicks BURN!, the download is capped to
+# PREFETCH_RATE_LIMIT, such that it does not get in the way of anything else using
+# the network, and its progress is not shown.
+#
+# The backendThread then takes the download job over instead of starting its own:
+# the speed cap is lifted and the progress is reported to the UI from there on.
+
+
+import threading
+
+from src.common.jobs import Job
+from src.common.download import download_kano_os
+from src.common.utils import debugger, DOWNLOAD_RATE_LIMIT, PREFETCH_RATE_LIMIT
+
+
+class ImagePrefetch(object):
+    '''
+    This class submits a download job for the latest Kano OS image
+    which can later be handed over to the burning process.
+    '''
+
+    def __init__(self, scheduler, downloader_class):
+        self.scheduler = scheduler
+        self.downloader_class = downloader_class
+        self.downloader = None
+        self.report_progress_ui = None
+        self.lock = threading.Lock()
+
+        debugger('Prefetching Kano OS at {} KB/s'.format(PREFETCH_RATE_LIMIT))
+        self.job = scheduler.submit(Job('prefetch', self.download, 'network'))
+
+    def download(self, job):
+        # the speed is limited by get_downloader() and lifted by handOver()
+        return download_kano_os(self.report_progress, self.get_downloader, rate_limit=0,
+                                cancelled=job.cancelled)
+
+    def get_downloader(self, *args, **kwargs):
+        with self.lock:
+            self.downloader = self.downloader_class(*args, **kwargs)
+            if not self.report_progress_ui and PREFETCH_RATE_LIMIT > 0:
+                self.downloader.limit_speed(PREFETCH_RATE_LIMIT)
+            return self.downloader
+
+    def report_progress(self, progress, text):
+        with self.lock:
+            report_progress_ui = self.report_progress_ui
+        if report_progress_ui:
+            report_progress_ui(progress, text)
+
+    def isUsable(self):
+        # a failed prefetch is not handed over, the image is downloaded again instead
+        return not self.job.done.is_set() or self.job.isSuccessful()
+
+    def handOver(self, report_progress_ui):
+        '''
+        This method lifts the speed cap, sends the progress to the given
+        method from now on and returns the download job.
+        '''
+
+        with self.lock:
+            self.report_progress_ui = report_progress_ui
+            if self.downloader:
+                self.downloader.limit_speed(DOWNLOAD_RATE_LIMIT if DOWNLOAD_RATE_LIMIT > 0 else -1)
+
+        debugger('Prefetched download handed over, {}'.format(self.job.state))
+        if self.job.isSuccessful():
+            report_progress_ui(100, 'download completed')
+        return self.job
+
+    def cancel(self):
+        self.scheduler.cancel(self.job)
+        with self.lock:
+            # PySmartDL is stopped, aria2 has to be shut down
+            if self.downloader and not self.job.done.is_set():
+                getattr(self.downloader, 'stop', self.downloader.close)()
@@ -13,10 +13,10 @@ import hashlib
 import logging
 from urlparse import urlparse
 from StringIO import StringIO
-import multiprocessing.dummy as multiprocessing
-from ctypes import c_int
 
 import utils
+import connectionpool
+from scheduler import RangeScheduler, ThreadsTuner
 
 __all__ = ['SmartDL', 'utils']
 __version_mjaor__ = 1
@@ -97,15 +97,22 @@ class SmartDL:
 
         self.headers = {'User-Agent': utils.get_random_useragent()}
         self.threads_count = 3
+        self.max_threads_count = self.threads_count
+        self.adaptive_threads = False
         self.timeout = 4
         self.current_attemp = 1
         self.attemps_limit = 4
         self.minChunkFile = 1024**2*2 # 2MB
+        self.range_size = 1024**2*4 # 4MB, the size of the ranges handed out to the threads
+        self.min_steal_size = 1024**2/2 # 512KB, ranges smaller than twice this are never split
+        self.buffer_size = 1024*128 # 128KB, the receive buffer of each thread
+        self.rate_limiter = utils.TokenBucket() # shared by all threads, see limit_speed()
         self.filesize = 0
-        self.shared_var = multiprocessing.Value(c_int, 0) # a ctypes var that counts the bytes already downloaded
         self.thread_shared_cmds = {}
         self.status = "ready"
+        self._finished = threading.Event() # set together with the "finished" status
         self.verify_hash = False
+        self.hash_time = None
         self._killed = False
         self._failed = False
         self._start_func_blocking = True
@@ -113,11 +120,14 @@ class SmartDL:
 
         self.post_threadpool_thread = None
         self.control_thread = None
+        self.scheduler = None
+        self.tuner = None
 
         if not os.path.exists(os.path.dirname(self.dest)):
             self.logger.debug('Folder "%s" does not exist. Creating...' % os.path.dirname(self.dest))
             os.makedirs(os.path.dirname(self.dest))
-        if not utils.is_HTTPRange_supported(self.url):
+        self.range_supported = utils.is_HTTPRange_supported(self.url)
+        if not self.range_supported:
             self.logger.warning("Server does not support HTTPRange. threads_count is set to 1.")
             self.threads_count = 1
         if os.path.exists(self.dest):
@@ -146,6 +156,30 @@ class SmartDL:
         base64string = base64.standard_b64encode(auth_string.encode('utf-8'))
         self.headers['Authorization'] = b"Basic " + base64string
 
+    def use_adaptive_threads(self, max_threads=8):
+        '''
+        Adjusts the number of connections to the measured throughput while downloading.
+
+        The download starts with `threads_count` connections and opens more as long as the
+        overall speed keeps improving, up to `max_threads`. Connections are dropped again
+        when the server refuses them (HTTP 416/503) or a thread stalls. The chosen number of
+        connections and their speeds are written to the log.
+
+        Will raise `RuntimeError` if it's called after the download has started.
+
+        :param max_threads: Maximum number of connections. Default is 8.
+        :type max_threads: int
+        '''
+        if not self.status == "ready":
+            raise RuntimeError("cannot change threads (current status is %s)" % self.status)
+        if not self.range_supported:
+            self.logger.warning("Server does not support HTTPRange. Adaptive threads are disabled.")
+            return
+
+        self.adaptive_threads = True
+        self.max_threads_count = max_threads
+        self.pool = utils.ManagedThreadPoolExecutor(max_threads)
+
     def add_hash_verification(self, algorithm, hash):
         '''
         Adds hash verification to the download.
@@ -188,7 +222,7 @@ class SmartDL:
         for filename in default_sums_filenames:
             try:
                 sums_url = "%s/%s" % (folder, filename)
-                obj = urllib2.urlopen(sums_url)
+                obj = connectionpool.urlopen(sums_url)
                 data = obj.read().split('\n')
                 obj.close()
 
@@ -233,13 +267,12 @@ class SmartDL:
                 hash = hashlib.new(self.hash_algorithm, f.read()).hexdigest()
                 if hash == self.hash_code:
                     self.logger.debug("Destination '%s' already exists, and the hash matches. No need to download." % self.dest)
-                    self.status = 'finished'
+                    self._finish()
                     return
 
         self.logger.debug("Downloading '%s' to '%s'..." % (self.url, self.dest))
-        req = urllib2.Request(self.url, headers=self.headers)
         try:
-            urlObj = urllib2.urlopen(req, timeout=self.timeout)
+            urlObj = _open_head(self.url, self.headers, self.timeout)
         except (urllib2.HTTPError, urllib2.URLError), e:
             self.errors.append(e)
             if self.mirrors:
@@ -251,38 +284,41 @@ class SmartDL:
                 self.logger.warning(unicode(e))
                 self.errors.append(e)
                 self._failed = True
-                self.status = "finished"
+                self._finish()
                 raise
 
         try:
             self.filesize = int(urlObj.headers["Content-Length"])
             self.logger.debug("Content-Length is %d (%s)." % (self.filesize, utils.sizeof_human(self.filesize)))
-        except IndexError:
+        except (KeyError, ValueError):
             self.logger.warning("Server did not send Content-Length. Filesize is unknown.")
             self.filesize = 0
-
-        args = _calc_chunk_size(self.filesize, self.threads_count, self.minChunkFile)
-        bytes_per_thread = args[0][1]-args[0][0]
-        if len(args)>1:
-            self.logger.debug("Launching %d threads (downloads %s/Thread)." % (len(args),  utils.sizeof_human(bytes_per_thread)))
+        urlObj.close()
+
+        # the file is split into small ranges which are handed out to the threads on demand,
+        # if the server does not support ranges, the whole file is downloaded by one thread
+        threads = _calc_threads_count(self.filesize, self.threads_count, self.minChunkFile)
+        self.scheduler = RangeScheduler(self.filesize if self.range_supported else 0, self.range_size, self.min_steal_size,
+                                        workers_limit=threads, min_workers=1 if self.adaptive_threads else threads)
+        if threads > 1:
+            self.logger.debug("Launching %d threads (%d ranges of %s)." % (threads, self.scheduler.ranges_count, utils.sizeof_human(self.range_size)))
         else:
             self.logger.debug("Launching 1 thread.")
 
+        if self.adaptive_threads:
+            self.tuner = ThreadsTuner(self.scheduler, self._spawn_thread, self.max_threads_count, self.logger)
+
+        # the threads write their ranges directly to their place in a single temporary file
+        with open(self.dest+".part", 'wb') as f:
+            if self.range_supported:
+                f.truncate(self.filesize)
+
         self.status = "downloading"
 
-        for i, arg in enumerate(args):
-            req = self.pool.submit(     download,
-                                        self.url,
-                                        self.dest+".%.3d" % i,
-                                        arg[0],
-                                        arg[1],
-                                        copy.deepcopy(self.headers),
-                                        self.timeout,
-                                        self.shared_var,
-                                        self.thread_shared_cmds
-                                        )
-
-        self.post_threadpool_thread = threading.Thread(target=post_threadpool_actions, args=(self.pool, [[(self.dest+".%.3d" % i) for i in range(len(args))], self.dest], self.filesize, self))
+        for i in range(threads):
+            self._spawn_thread()
+
+        self.post_threadpool_thread = threading.Thread(target=post_threadpool_actions, args=(self.pool, self.scheduler, [self.dest+".part", self.dest], self.filesize, self))
         self.post_threadpool_thread.daemon = True
         self.post_threadpool_thread.start()
 
@@ -291,6 +327,29 @@ class SmartDL:
         if blocking:
             self.wait(raise_exceptions=True)
 
+    def _spawn_thread(self):
+        self.pool.submit(   download,
+                            self.url,
+                            self.dest+".part",
+                            self.scheduler,
+                            copy.deepcopy(self.headers),
+                            self.timeout,
+                            self.thread_shared_cmds,
+                            None,
+                            self.buffer_size,
+                            self.rate_limiter
+                            )
+
+    def _finish(self):
+        "Marks the task as finished and wakes up everyone waiting for it."
+        if self.control_thread:
+            self.control_thread.stop_timer()
+        self.pool.shutdown(wait=False)
+        self.status = "finished"
+        self._finished.set()
+        if self.control_thread and not self._failed and not self._killed:
+            self.logger.debug("File downloaded within %.2f seconds." % self.get_dl_time())
+
     def _exc_callback(self, req, e):
         self.errors.append(e[0])
         self.logger.exception(e[1])
@@ -299,7 +358,6 @@ class SmartDL:
         if self.current_attemp < self.attemps_limit:
             self.current_attemp += 1
             self.status = "ready"
-            self.shared_var.value = 0
             self.thread_shared_cmds = {}
             self.start()
 
@@ -315,7 +373,6 @@ class SmartDL:
             if e:
                 self.errors.append(e)
             self.status = "ready"
-            self.shared_var.value = 0
             self.url = self.mirrors.pop(0)
             self.start()
         else:
@@ -378,9 +435,7 @@ class SmartDL:
         '''
         if self.status == "ready":
             return False
-        if self.status == "finished":
-            return True
-        return not self.post_threadpool_thread.is_alive()
+        return self._finished.is_set()
     def isSuccessful(self):
         '''
         Returns if the download is successfull. It may fail in the following scenarios:
@@ -400,12 +455,8 @@ class SmartDL:
         if self._killed:
             return False
 
-        n = 0
-        while self.status != 'finished':
-            n += 1
-            time.sleep(0.1)
-            if n >= 15:
-                raise RuntimeError("The download task must be finished in order to see if it's successful. (current status is %s)" % self.status)
+        if not self._finished.wait(1.5):
+            raise RuntimeError("The download task must be finished in order to see if it's successful. (current status is %s)" % self.status)
 
         return not self._failed
 
@@ -435,9 +486,8 @@ class SmartDL:
         if self.status == "finished":
             return
 
-        while not self.isFinished():
-            time.sleep(0.1)
-        self.post_threadpool_thread.join()
+        # without a timeout, the wait blocks until the event is set instead of polling
+        self._finished.wait()
         self.control_thread.join()
 
         if self._failed and raise_exceptions:
@@ -464,17 +514,20 @@ class SmartDL:
             self.status = "downloading"
             del self.thread_shared_cmds['pause']
 
-    # def limit_speed(self, kbytes=-1):
-        # '''
-        # Limits the download transfer speed.
+    def limit_speed(self, kbytes=-1):
+        '''
+        Limits the download transfer speed. The limit is shared by all the threads and
+        may be changed at any time, including before the download is started.
 
-        # :param kbytes: Number of Kilobytes to download per second. Negative values will not limit the speed. Default is `-1`.
-        # :type kbytes: int
-        # '''
-        # if kbytes == 0:
-            # self.pause()
-        # if kbytes > 0 and self.status == "downloading":
-            # self.thread_shared_cmds['limit'] = 1.0*kbytes/self.threads_count
+        :param kbytes: Number of Kilobytes to download per second. Negative values will not limit the speed. Default is `-1`.
+        :type kbytes: int
+        '''
+        if kbytes == 0:
+            self.pause()
+            return
+        if self.status == "paused":
+            self.unpause()
+        self.rate_limiter.set_rate(kbytes*1024 if kbytes > 0 else 0)
 
     def get_dest(self):
         '''
@@ -499,6 +552,15 @@ class SmartDL:
             return utils.time_human(self.control_thread.get_dl_time())
         return self.control_thread.get_dl_time()
 
+    def get_hash_time(self):
+        '''
+        Returns how much time did the hash verification take, in seconds. Returns
+        `None` if the hash was not verified (yet).
+
+        :rtype: float
+        '''
+        return self.hash_time
+
     def get_dl_size(self, human=False):
         '''
         Get downloaded bytes counter in bytes.
@@ -554,7 +616,6 @@ class ControlThread(threading.Thread):
         self.obj = obj
         self.progress_bar = obj.progress_bar
         self.logger = obj.logger
-        self.shared_var = obj.shared_var
 
         self.dl_speed = 0
         self.eta = 0
@@ -564,48 +625,45 @@ class ControlThread(threading.Thread):
         self.calcETA_i = 0
         self.calcETA_val = 0
         self.dl_time = -1.0
+        self.start_time = time.time()
 
         self.daemon = True
         self.start()
 
     def run(self):
-        t1 = time.time()
-
+        # this loop only wakes up to refresh the progress, the task is finished
+        # by post_threadpool_actions as soon as the threads are done
         while not self.obj.pool.done():
-            self.dl_speed = self.calcDownloadSpeed(self.shared_var.value)
+            if self.obj.tuner:
+                self.obj.tuner.update()
+
+            dl_bytes = self.get_dl_bytes()
+            self.dl_speed = self.calcDownloadSpeed(dl_bytes)
             if self.dl_speed > 0:
-                self.eta = self.calcETA((self.obj.filesize-self.shared_var.value)/self.dl_speed)
+                self.eta = self.calcETA((self.obj.filesize-dl_bytes)/self.dl_speed)
 
             if self.progress_bar:
                 if self.obj.filesize:
-                    status = r"[*] %s / %s @ %s/s %s [%3.1f%%, %s left]   " % (utils.sizeof_human(self.shared_var.value), utils.sizeof_human(self.obj.filesize), utils.sizeof_human(self.dl_speed), utils.progress_bar(1.0*self.shared_var.value/self.obj.filesize), self.shared_var.value * 100.0 / self.obj.filesize, utils.time_human(self.eta, fmt_short=True))
+                    status = r"[*] %s / %s @ %s/s %s [%3.1f%%, %s left]   " % (utils.sizeof_human(dl_bytes), utils.sizeof_human(self.obj.filesize), utils.sizeof_human(self.dl_speed), utils.progress_bar(1.0*dl_bytes/self.obj.filesize), dl_bytes * 100.0 / self.obj.filesize, utils.time_human(self.eta, fmt_short=True))
                 else:
-                    status = r"[*] %s / ??? MB @ %s/s   " % (utils.sizeof_human(self.shared_var.value), utils.sizeof_human(self.dl_speed))
+                    status = r"[*] %s / ??? MB @ %s/s   " % (utils.sizeof_human(dl_bytes), utils.sizeof_human(self.dl_speed))
                 status = status + chr(8)*(len(status)+1)
                 print status,
 
             time.sleep(0.1)
 
         if self.obj._killed:
-            self.logger.debug("File download process has been stopped.")
             return
 
         if self.progress_bar:
             if self.obj.filesize:
                 print r"[*] %s / %s @ %s/s %s [100%%, 0s left]    " % (utils.sizeof_human(self.obj.filesize), utils.sizeof_human(self.obj.filesize), utils.sizeof_human(self.dl_speed), utils.progress_bar(1.0))
             else:
-                print r"[*] %s / %s @ %s/s    " % (utils.sizeof_human(self.shared_var.value), self.shared_var.value / 1024.0**2, utils.sizeof_human(self.dl_speed))
+                print r"[*] %s / %s @ %s/s    " % (utils.sizeof_human(self.get_dl_bytes()), self.get_dl_bytes() / 1024.0**2, utils.sizeof_human(self.dl_speed))
 
-        t2 = time.time()
-        self.dl_time = float(t2-t1)
-
-        while self.obj.post_threadpool_thread.is_alive():
-            time.sleep(0.1)
-
-        self.obj.pool.shutdown()
-        self.obj.status = "finished"
-        if not self.obj.errors:
-            self.logger.debug("File downloaded within %.2f seconds." % self.dl_time)
+    def stop_timer(self):
+        if self.dl_time < 0:
+            self.dl_time = float(time.time()-self.start_time)
 
     def get_eta(self):
         if self.eta <= 0 or self.obj.status == 'paused':
@@ -615,16 +673,22 @@ class ControlThread(threading.Thread):
         if self.obj.status == 'paused':
             return 0
         return self.dl_speed
+    def get_dl_bytes(self):
+        # each thread counts its own bytes, we only sum them up here
+        if not self.obj.scheduler:
+            return 0
+        return self.obj.scheduler.get_downloaded_bytes()
     def get_dl_size(self):
-        if self.shared_var.value > self.obj.filesize:
+        dl_bytes = self.get_dl_bytes()
+        if dl_bytes > self.obj.filesize:
             return self.obj.filesize
-        return self.shared_var.value
+        return dl_bytes
     def get_final_filesize(self):
         return self.obj.filesize
     def get_progress(self):
         if not self.obj.filesize:
             return 0
-        return 1.0*self.shared_var.value/self.obj.filesize
+        return 1.0*self.get_dl_bytes()/self.obj.filesize
     def get_dl_time(self):
         return self.dl_time
 
@@ -662,80 +726,128 @@ class ControlThread(threading.Thread):
             return 0
         return self.calcETA_val
 
-def post_threadpool_actions(pool, args, expected_filesize, SmartDL_obj):
+def post_threadpool_actions(pool, scheduler, args, expected_filesize, SmartDL_obj):
     "Run function after thread pool is done. Run this in a thread."
-    while not pool.done():
-        time.sleep(0.1)
-
-    if pool.get_exceptions():
-        SmartDL_obj.logger.warning(unicode(pool.get_exceptions()[0]))
-        SmartDL_obj.retry(unicode(pool.get_exceptions()[0]))
-
+    pool.wait()
 
     if SmartDL_obj._killed:
+        SmartDL_obj.logger.debug("File download process has been stopped.")
+        SmartDL_obj._finish()
+        return
+
+    # a thread may have failed while the others took over its ranges,
+    # we only need to retry if some part of the file is still missing
+    if pool.get_exceptions() and not scheduler.is_complete():
+        SmartDL_obj.logger.warning(unicode(pool.get_exceptions()[0]))
+        _retry_or_finish(SmartDL_obj, SmartDL_obj.retry, unicode(pool.get_exceptions()[0]))
         return
 
     if SmartDL_obj._failed:
         SmartDL_obj.logger.warning("Task has errors. Exiting...")
+        SmartDL_obj._finish()
         return
 
     if expected_filesize: # if not zero, etc expected filesize is not known
-        threads = len(args[0])
-        total_filesize = sum([os.path.getsize(x) for x in args[0]])
+        total_filesize = os.path.getsize(args[0])
         diff = math.fabs(expected_filesize - total_filesize)
 
-        # if the difference is more than 4*thread numbers (because a thread may download 4KB more per thread because of NTFS's block size)
-        if diff > 4*threads:
-            SmartDL_obj.logger.warning('Diff between downloaded files and expected filesizes is %dKB. Retrying...' % diff)
-            SmartDL_obj.retry('Diff between downloaded files and expected filesizes is %dKB.' % diff)
+        if diff or not scheduler.is_complete():
+            SmartDL_obj.logger.warning('Diff between downloaded file and expected filesize is %dKB. Retrying...' % diff)
+            _retry_or_finish(SmartDL_obj, SmartDL_obj.retry, 'Diff between downloaded file and expected filesize is %dKB.' % diff)
             return
 
+    if scheduler.steals:
+        SmartDL_obj.logger.debug("Idle threads took over %d ranges from slower threads." % scheduler.steals)
+    if SmartDL_obj.tuner:
+        SmartDL_obj.logger.debug("Finished with %d connections." % scheduler.workers_limit)
+
     SmartDL_obj.status = "combining"
-    utils.combine_files(*args)
+    if os.path.exists(args[1]):
+        os.remove(args[1])
+    os.rename(*args)
 
     if SmartDL_obj.verify_hash:
         dest_path = args[-1]
+        hash_start = time.time()
         with open(dest_path, 'rb') as f:
             hash = hashlib.new(SmartDL_obj.hash_algorithm, f.read()).hexdigest()
+        SmartDL_obj.hash_time = time.time() - hash_start
 
         if hash == SmartDL_obj.hash_code:
             SmartDL_obj.logger.debug('Hash verification succeeded.')
         else:
             SmartDL_obj.logger.debug('Hash verification failed.')
-            SmartDL_obj.try_next_mirror(HashFailedException(os.path.basename(dest_path), hash, SmartDL_obj.hash_code))
+            _retry_or_finish(SmartDL_obj, SmartDL_obj.try_next_mirror, HashFailedException(os.path.basename(dest_path), hash, SmartDL_obj.hash_code))
+            return
+
+    SmartDL_obj._finish()
+
+def _retry_or_finish(SmartDL_obj, func, arg):
+    "Calls SmartDL.retry or SmartDL.try_next_mirror. If no new attempt was started, the task is finished."
+    try:
+        func(arg)
+    finally:
+        if SmartDL_obj._failed and not SmartDL_obj.isFinished():
+            SmartDL_obj._finish()
+
+def _open_head(url, headers, timeout):
+    "Opens the url with a HEAD request, or a GET request if the server refuses HEAD."
+    try:
+        return connectionpool.urlopen(url, headers, timeout, method='HEAD')
+    except urllib2.HTTPError, e:
+        if e.code not in (405, 501):
+            raise
+    return connectionpool.urlopen(url, headers, timeout)
 
-def _calc_chunk_size(filesize, threads, minChunkFile):
+def _calc_threads_count(filesize, threads, minChunkFile):
     if not filesize:
-        return [(0, 0)]
+        return 1
 
     while filesize/threads < minChunkFile and threads > 1:
         threads -= 1
 
-    args = []
-    pos = 0
-    chunk = filesize/threads
-    for i in range(threads):
-        startByte = pos
-        endByte = pos + chunk
-        if endByte > filesize-1:
-            endByte = filesize-1
-        args.append((startByte, endByte))
-        pos += chunk+1
-
-    return args
-
-def download(url, dest, startByte=0, endByte=None, headers=None, timeout=4, shared_var=None, thread_shared_cmds=None, logger=None, retries=1):
-    "The basic download function that runs at each thread."
+    return threads
+
+def download(url, dest, scheduler, headers=None, timeout=4, thread_shared_cmds=None, logger=None, buffer_size=128*1024, rate_limiter=None):
+    "The basic download function that runs at each thread. Downloads ranges until the scheduler runs out of them."
+    logger = logger or utils.DummyLogger()
+    buff = bytearray(buffer_size) # received data is written directly to this buffer, for all the ranges
+
+    worker = scheduler.add_worker()
+    try:
+        with open(dest, 'r+b') as f:
+            while True:
+                r = scheduler.acquire(worker)
+                if not r:
+                    break
+
+                eof = False
+                try:
+                    eof = download_range(url, f, buff, worker, scheduler, copy.copy(headers), timeout, thread_shared_cmds, logger, rate_limiter)
+                except urllib2.HTTPError, e:
+                    # the server does not want this many connections, leave the range to the
+                    # other threads and stop if we are now over the limit (adaptive threads only)
+                    if e.code not in (416, 503) or not scheduler.backoff():
+                        raise
+                    logger.warning("Server refused the connection (HTTP %d), backing off." % e.code)
+                finally:
+                    scheduler.release(worker, eof)
+    finally:
+        scheduler.remove_worker(worker)
+
+def download_range(url, f, buff, worker, scheduler, headers=None, timeout=4, thread_shared_cmds=None, logger=None, rate_limiter=None, retries=1):
+    "Downloads the range of the worker to the opened file through the buffer. Returns if the server has sent everything it had."
     logger = logger or utils.DummyLogger()
+    r = worker.range
     if not headers:
         headers = {}
-    if endByte:
-        headers['Range'] = 'bytes=%d-%d' % (startByte, endByte)
+    if r.end is not None:
+        headers['Range'] = 'bytes=%d-%d' % (r.pos, r.end)
 
-    logger.debug("Downloading '%s' to '%s'..." % (url, dest))
-    req = urllib2.Request(url, headers=headers)
+    logger.debug("Downloading '%s' %r..." % (url, r))
     try:
-        urlObj = urllib2.urlopen(req, timeout=timeout)
+        # the connection is reused across ranges if we read the range to its end
+        urlObj = connectionpool.urlopen(url, headers, timeout)
     except urllib2.HTTPError, e:
         if e.code == 416:
             '''
@@ -749,60 +861,56 @@ def download(url, dest, startByte=0, endByte=None, headers=None, timeout=4, shar
             if retries > 0:
                 logger.warning("Thread didn't got the file it was expecting. Retrying (%d times left)..." % (retries-1))
                 time.sleep(5)
-                return download(url, dest, startByte, endByte, headers, timeout, shared_var, thread_shared_cmds, logger, retries-1)
+                return download_range(url, f, buff, worker, scheduler, headers, timeout, thread_shared_cmds, logger, rate_limiter, retries-1)
             else:
                 raise
         else:
             raise
 
-    with open(dest, 'wb') as f:
-        if endByte:
-            filesize = endByte-startByte
-        else:
-            try:
-                meta = urlObj.info()
-                filesize = int(meta.getheaders("Content-Length")[0])
-                logger.debug("Content-Length is %d." % filesize)
-            except IndexError:
-                logger.warning("Server did not send Content-Length.")
-
-        filesize_dl = 0 # total downloaded size
-        # limitspeed_timestamp = 0
-        # limitspeed_filesize = 0
-        block_sz = 8192
-        while True:
-            if thread_shared_cmds:
-                if 'stop' in thread_shared_cmds:
-                    logger.error('stop command issued.')
-                    raise CanceledException()
-                if 'pause' in thread_shared_cmds:
-                    time.sleep(0.2)
-                    continue
-                # if 'limit' in thread_shared_cmds:
-                    # currect_time = int(time.time())
-                    # if limitspeed_timestamp == currect_time:
-                        # if limitspeed_filesize >= thread_shared_cmds['limit']:
-                            # time.sleep(0.05)
-                            # continue
-                    # else:
-                        # limitspeed_timestamp = currect_time
-                        # limitspeed_filesize = 0
+    if 'Range' in headers and r.pos and urlObj.getcode() != 206:
+        urlObj.close()
+        raise IOError("Server ignored the Range header for %r" % r)
+
+    start_pos = r.pos
+    f.seek(r.pos)
+    view = memoryview(buff)
+    rate_limiter = rate_limiter or utils.TokenBucket()
+
+    while True:
+        if thread_shared_cmds:
+            if 'stop' in thread_shared_cmds:
+                logger.error('stop command issued.')
+                raise CanceledException()
+            if 'pause' in thread_shared_cmds:
+                time.sleep(0.2)
+                continue
 
-            try:
-                buff = urlObj.read(block_sz)
-            except Exception, e:
-                logger.error(unicode(e))
-                if shared_var:
-                    shared_var.value -= filesize_dl
-                raise
+        try:
+            # with a speed limit, we read in small steps to keep the rate smooth
+            received = urlObj.readinto(view[:rate_limiter.chunk_size(len(buff))])
+        except Exception, e:
+            logger.error(unicode(e))
+            urlObj.close()
+            raise
+
+        if not received:
+            break
 
-            if not buff:
-                break
+        # the end of the range may have been stolen by an idle thread,
+        # in which case we stop as soon as we reach it
+        n = scheduler.claim(worker, received)
+        f.write(view[:n])
 
-            filesize_dl += len(buff)
-            # limitspeed_filesize += len(buff)
-            if shared_var:
-                shared_var.value += len(buff)
-            f.write(buff)
+        # the progress counter is owned by this thread, no locking needed
+        worker.bytes += n
+        rate_limiter.consume(received)
+
+        if n < received or not r.remaining() and r.end is not None:
+            break
 
     urlObj.close()
+
+    if r.remaining() and r.pos == start_pos:
+        raise IOError("Server closed the connection without sending %r" % r)
+
+    return not received
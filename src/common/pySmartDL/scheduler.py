@@ -0,0 +1,335 @@
+# -*- coding: utf-8 -*-
+# Copyright (C) 2015 Kano Computing Ltd.
+'''
+The scheduler hands out byte ranges of the downloaded file to the worker threads.
+
+The file is split into small ranges which are kept in a shared queue. Every idle
+worker takes the next range from the queue. Once the queue is empty, an idle worker
+steals the second half of the largest range still being downloaded by another worker,
+such that the end of the download is not bound by the slowest connection.
+
+The number of workers may be adjusted while downloading by the `ThreadsTuner`.
+'''
+
+import time
+import threading
+from collections import deque
+
+import utils
+
+class Range(object):
+    '''
+    A byte range of the file, downloaded by a single worker at a time.
+
+    `pos` is the offset of the next byte to be written and `end` is the offset of
+    the last byte of the range (inclusive). `end` is `None` if the size of the file
+    is unknown. It may shrink while the range is being downloaded, when another
+    worker steals its tail.
+    '''
+    def __init__(self, start, end):
+        self.start = start
+        self.pos = start
+        self.end = end
+
+    def __repr__(self):
+        return "<Range %d-%s @ %d>" % (self.start, self.end, self.pos)
+
+    def remaining(self):
+        '''
+        Returns the number of bytes left to download, or `0` for open ranges.
+
+        :rtype: int
+        '''
+        if self.end is None:
+            return 0
+        return self.end - self.pos + 1
+
+class Worker(object):
+    '''
+    Bookkeeping for a single download thread: the range it is working on and
+    the number of bytes it has downloaded so far.
+
+    `bytes` is only ever incremented by the thread itself, other threads just read
+    it, so it does not need a lock. Python ints do not overflow, unlike the shared
+    C int which was used before, so files larger than 2GB are counted correctly.
+    '''
+    def __init__(self, id):
+        self.id = id
+        self.range = None
+        self.bytes = 0
+        self.retired = False
+
+    def __repr__(self):
+        return "<Worker #%d %r>" % (self.id, self.range)
+
+class RangeScheduler(object):
+    '''
+    A thread-safe queue of byte ranges, shared by all the workers of a download.
+
+    :param filesize: Size of the file in bytes. If `0`, the file will be downloaded as a single open range.
+    :type filesize: int
+    :param range_size: Size of the ranges the file is split into, in bytes.
+    :type range_size: int
+    :param min_steal_size: A range is only split if both halves would be at least this big, in bytes.
+    :type min_steal_size: int
+    :param workers_limit: Number of workers allowed to download at the same time.
+    :type workers_limit: int
+    :param min_workers: The `backoff()` method never lowers `workers_limit` below this number.
+    :type min_workers: int
+    '''
+    def __init__(self, filesize, range_size, min_steal_size, workers_limit=1, min_workers=None):
+        self.filesize = filesize
+        self.min_steal_size = min_steal_size
+        self.workers_limit = workers_limit
+        self.min_workers = workers_limit if min_workers is None else min_workers
+        self.lock = threading.Lock()
+        self.pending = deque()
+        self.active = []
+        self.workers = []
+        self.all_workers = [] # including those which have stopped, for the progress counters
+        self.done_bytes = 0
+        self.steals = 0
+        self.backoffs = 0
+        self.eof = False
+
+        if not filesize:
+            self.pending.append(Range(0, None))
+        else:
+            pos = 0
+            while pos < filesize:
+                end = min(pos + range_size, filesize) - 1
+                self.pending.append(Range(pos, end))
+                pos = end + 1
+        self.ranges_count = len(self.pending)
+
+    def add_worker(self):
+        '''
+        Registers a new download thread.
+
+        :rtype: `Worker` instance
+        '''
+        with self.lock:
+            worker = Worker(len(self.all_workers)+1)
+            self.workers.append(worker)
+            self.all_workers.append(worker)
+            return worker
+
+    def remove_worker(self, worker):
+        with self.lock:
+            self.workers.remove(worker)
+
+    def acquire(self, worker):
+        '''
+        Returns the next range for the worker to download, or `None` if there is
+        no work left or the worker should stop because `workers_limit` was lowered.
+
+        :rtype: `Range` instance
+        '''
+        with self.lock:
+            if worker.retired or len([w for w in self.workers if not w.retired]) > self.workers_limit:
+                return None
+            if self.pending:
+                r = self.pending.popleft()
+            else:
+                r = self._steal()
+            if r:
+                self.active.append(r)
+            worker.range = r
+            return r
+
+    def backoff(self):
+        '''
+        Lowers `workers_limit` by one, e.g. when the server refuses a connection.
+        Returns `False` if it is already at `min_workers`.
+
+        :rtype: bool
+        '''
+        with self.lock:
+            if self.workers_limit <= self.min_workers:
+                return False
+            self.workers_limit -= 1
+            self.backoffs += 1
+            return True
+
+    def retire(self, worker_id):
+        '''
+        Takes the rest of the range away from a stalled worker and queues it for the
+        other workers. The stalled worker stops once its read returns or times out.
+        Returns `False` if the worker is not downloading a sized range.
+
+        :rtype: bool
+        '''
+        with self.lock:
+            worker = [w for w in self.workers if w.id == worker_id]
+            if not worker or worker[0].retired or not worker[0].range or worker[0].range.end is None:
+                return False
+
+            worker = worker[0]
+            r = worker.range
+            worker.retired = True
+            if r.remaining() > 0:
+                self.pending.appendleft(Range(r.pos, r.end))
+                r.end = r.pos - 1
+            return True
+
+    def grow(self, max_workers):
+        '''
+        Raises `workers_limit` by one if it is below `max_workers` and there are
+        ranges nobody is downloading yet. Returns whether it was raised.
+
+        :rtype: bool
+        '''
+        with self.lock:
+            if self.workers_limit >= max_workers or not self.pending:
+                return False
+            self.workers_limit += 1
+            return True
+
+    def _steal(self):
+        # split the range with the most bytes left to download in half,
+        # the worker which owns it stops once it reaches the new end
+        candidates = [r for r in self.active if r.remaining() >= 2*self.min_steal_size]
+        if not candidates:
+            return None
+
+        victim = max(candidates, key=lambda r: r.remaining())
+        middle = victim.pos + victim.remaining()//2
+        stolen = Range(middle, victim.end)
+        victim.end = middle-1
+        self.steals += 1
+        return stolen
+
+    def claim(self, worker, nbytes):
+        '''
+        Called by the worker before writing `nbytes` at the position of its range.
+        Returns how many of them belong to the range, as its end may have been
+        stolen in the meantime.
+
+        :rtype: int
+        '''
+        with self.lock:
+            r = worker.range
+            if r.end is not None:
+                nbytes = max(min(nbytes, r.end-r.pos+1), 0)
+            r.pos += nbytes
+            self.done_bytes += nbytes
+            return nbytes
+
+    def release(self, worker, eof=False):
+        '''
+        Called by the worker once it stops working on a range, whether it finished or
+        failed. Any part of the range which was not downloaded is queued again.
+
+        :param eof: If true, the server has sent the whole file. Only used for open ranges.
+        :type eof: bool
+        '''
+        with self.lock:
+            r = worker.range
+            worker.range = None
+            self.active.remove(r)
+            if r.remaining() > 0:
+                self.pending.appendleft(Range(r.pos, r.end))
+            if eof and r.end is None:
+                self.eof = True
+
+    def get_downloaded_bytes(self):
+        '''
+        Returns the number of bytes downloaded by all the workers so far.
+
+        :rtype: int
+        '''
+        return sum([w.bytes for w in self.all_workers])
+
+    def is_complete(self):
+        '''
+        Returns if every byte of the file has been downloaded.
+
+        :rtype: bool
+        '''
+        with self.lock:
+            if not self.filesize:
+                return self.eof
+            return self.done_bytes >= self.filesize
+
+class ThreadsTuner(object):
+    '''
+    Adjusts the number of download threads to the measured throughput.
+
+    Every `interval` seconds it compares the overall download speed to the previous
+    one. As long as every new connection makes the download faster by at least
+    `min_gain`, it opens another one, up to `max_workers`. When a connection did not
+    help or the server refused one (see `RangeScheduler.backoff()`), it drops a
+    connection and stops ramping up. A thread which stalled gives its range back
+    (see `RangeScheduler.retire()`) and is replaced by a new one.
+
+    :param scheduler: The scheduler of the download.
+    :type scheduler: `RangeScheduler` instance
+    :param spawn: Function which starts a new download thread.
+    :type spawn: function
+    :param max_workers: Maximum number of threads.
+    :type max_workers: int
+    :param logger: Logger for the chosen connection count and per-connection speeds.
+    :type logger: `logging.Logger` instance
+    '''
+    def __init__(self, scheduler, spawn, max_workers, logger, interval=2.0, min_gain=1.1):
+        self.scheduler = scheduler
+        self.spawn = spawn
+        self.max_workers = max_workers
+        self.logger = logger
+        self.interval = interval
+        self.min_gain = min_gain
+
+        self.ramping = True
+        self.last_limit = scheduler.workers_limit
+        self.last_time = time.time()
+        self.last_rate = 0
+        self.last_done_bytes = 0
+        self.last_worker_bytes = {}
+
+    def update(self):
+        '''
+        Called periodically while downloading, does nothing until `interval` has passed.
+        '''
+        now = time.time()
+        duration = now - self.last_time
+        if duration < self.interval:
+            return
+
+        s = self.scheduler
+        with s.lock:
+            done_bytes = s.done_bytes
+            workers = [(w.id, w.bytes, w.range is not None) for w in s.workers if not w.retired]
+            backoffs = s.backoffs
+            s.backoffs = 0
+
+        rate = (done_bytes-self.last_done_bytes)/duration
+        rates = [(id, (bytes-self.last_worker_bytes.get(id, 0))/duration, busy) for id, bytes, busy in workers]
+        stalled = [id for id, worker_rate, busy in rates if busy and id in self.last_worker_bytes and not worker_rate]
+        self.last_worker_bytes = dict((id, bytes) for id, bytes, _ in workers)
+        self.last_done_bytes = done_bytes
+        self.last_time = now
+
+        if backoffs or stalled:
+            # a stalled connection gives its range back and is replaced by a new one,
+            # rather than retiring whichever healthy worker asks for a range next
+            for id in stalled:
+                if s.retire(id):
+                    self.spawn()
+            reason = "server refused a connection" if backoffs else "%d thread(s) stalled" % len(stalled)
+            self.ramping = False
+        elif self.ramping and self.last_rate and rate < self.last_rate*self.min_gain:
+            # the last connection we opened did not make the download faster
+            s.backoff()
+            reason = "no gain from the last connection"
+            self.ramping = False
+        elif self.ramping and s.grow(self.max_workers):
+            self.spawn()
+            reason = "speed is still improving"
+        else:
+            reason = None
+        self.last_rate = rate
+
+        if reason:
+            self.logger.debug("Using %d connections (was %d, %s), %s/s overall: %s" % (s.workers_limit, self.last_limit, reason,
+                utils.sizeof_human(int(rate)), ', '.join(["#%d %s/s" % (id, utils.sizeof_human(int(worker_rate))) for id, worker_rate, _ in rates])))
+        self.last_limit = s.workers_limit
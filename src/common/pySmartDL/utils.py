@@ -12,9 +12,13 @@ import urllib2
 import random
 import logging
 import re
+import time
+import threading
 from concurrent import futures # if python2, a backport is needed
 from math import log
 
+import connectionpool
+
 def combine_files(parts, dest):
     '''
     Combines files.
@@ -95,8 +99,7 @@ def is_HTTPRange_supported(url, timeout=15):
         return False
     
     headers = {'Range': 'bytes=0-3'}
-    req = urllib2.Request(url, headers=headers)
-    urlObj = urllib2.urlopen(req, timeout=timeout)
+    urlObj = connectionpool.urlopen(url, headers=headers, timeout=timeout)
     filesize = int(urlObj.headers["Content-Length"])
     
     urlObj.close()
@@ -114,16 +117,22 @@ def get_filesize(url, timeout=15):
     :rtype: int
     '''
     # url = url_fix(url)
-    try:
-        urlObj = urllib2.urlopen(url, timeout=timeout)
-    except (urllib2.HTTPError, urllib2.URLError) as e:
-        return 0
-    try:
-        file_size = int(urlObj.headers["Content-Length"])
-    except IndexError:
-        return 0
-        
-    return file_size
+    # a HEAD request leaves the connection reusable, fall back to GET if the server refuses it
+    for method in ['HEAD', 'GET']:
+        try:
+            urlObj = connectionpool.urlopen(url, timeout=timeout, method=method)
+        except urllib2.HTTPError as e:
+            continue
+        except urllib2.URLError as e:
+            return 0
+        try:
+            return int(urlObj.headers["Content-Length"])
+        except (KeyError, ValueError):
+            continue
+        finally:
+            urlObj.close()
+
+    return 0
     
 def get_random_useragent():
     '''
@@ -257,24 +266,107 @@ class DummyLogger(object):
             return object.__getattr__(name)
         return self.dummy_func
         
+class TokenBucket(object):
+    '''
+    A token bucket rate limiter which can be shared by many threads.
+
+    Every thread calls `consume()` with the number of bytes it received. The bucket
+    refills at `rate` bytes per second and holds at most `burst` seconds worth of
+    bytes. If a thread takes more than there is, it sleeps until the bucket would
+    have refilled, which spreads the bandwidth evenly between the threads.
+
+    :param rate: Bytes per second. Zero or negative values do not limit the rate.
+    :type rate: int
+    :param burst: Size of the bucket, in seconds. Default is 0.1.
+    :type burst: float
+    '''
+    def __init__(self, rate=0, burst=0.1):
+        self.burst = burst
+        self.lock = threading.Lock()
+        self.set_rate(rate)
+
+    def set_rate(self, rate):
+        '''
+        Changes the rate, may be called while other threads are consuming.
+        
+        :param rate: Bytes per second. Zero or negative values do not limit the rate.
+        :type rate: int
+        '''
+        with self.lock:
+            self.rate = max(rate, 0)
+            self.tokens = self.rate*self.burst
+            self.last_time = time.time()
+
+    def chunk_size(self, default):
+        '''
+        Returns how many bytes a thread should read at once to keep the rate smooth.
+
+        :rtype: int
+        '''
+        if not self.rate:
+            return default
+        return int(min(max(self.rate*self.burst, 4096), default))
+
+    def consume(self, nbytes):
+        '''
+        Takes `nbytes` from the bucket, sleeping if they are not available yet.
+        '''
+        if not self.rate:
+            return
+
+        with self.lock:
+            if not self.rate:
+                return
+            now = time.time()
+            self.tokens = min(self.tokens + (now-self.last_time)*self.rate, self.rate*self.burst)
+            self.last_time = now
+            self.tokens -= nbytes
+            delay = -self.tokens/self.rate if self.tokens < 0 else 0
+
+        # the debt is already taken, so the next threads wait for their share after ours
+        if delay:
+            time.sleep(delay)
+
 class ManagedThreadPoolExecutor(futures.ThreadPoolExecutor):
     '''
+    A thread pool which keeps track of its futures. It counts the futures which
+    are not done yet, such that `done()` does not need to check each one of them
+    and `wait()` can block until the last one is done.
     '''
     def __init__(self, max_workers):
         futures.ThreadPoolExecutor.__init__(self, max_workers)
         self._futures = []
+        self._pending = 0
+        self._pending_cond = threading.Condition()
     
     def submit(self, fn, *args, **kwargs):
+        with self._pending_cond:
+            self._pending += 1
         future = super(ManagedThreadPoolExecutor, self).submit(fn, *args, **kwargs)
         self._futures.append(future)
+        future.add_done_callback(self._future_done)
         return future
+
+    def _future_done(self, future):
+        with self._pending_cond:
+            self._pending -= 1
+            if not self._pending:
+                self._pending_cond.notify_all()
     
     def done(self):
-        return all([x.done() for x in self._futures])
+        return not self._pending
+
+    def wait(self):
+        '''
+        Blocks until all the submitted futures are done.
+        '''
+        with self._pending_cond:
+            while self._pending:
+                self._pending_cond.wait()
        
     def get_exceptions(self):
         l = []
         for x in self._futures:
             if x.exception():
                 l.append(x.exception())
-        return l
\ No newline at end of file
+        return l
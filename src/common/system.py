@@ -0,0 +1,125 @@
+#!/usr/bin/env python
+
+# system.py
+#
+# Copyright (C) 2015 Kano Computing Ltd.
+# License: http://www.gnu.org/licenses/gpl-2.0.txt GNU General Public License v2
+#
+#
+# Querying the system in-process
+#
+# These helpers replace spawning df, which and where.exe and parsing their output,
+# which costs a fork/exec for every check and breaks with unexpected locales
+# or output formats. They work the same way on all three platforms.
+
+
+import os
+import platform
+import threading
+
+from src.common.utils import debugger, BYTES_IN_MEGABYTE
+
+
+# The regions at the start and end of a disk wiped before burning, in bytes
+# they hold the MBR, the GPT and its backup, and the first filesystem's superblock
+WIPE_SIZE = 1024 * 1024
+
+# the programs found so far, missing ones are looked up again as they may be installed meanwhile
+programs_cache = dict()
+programs_lock = threading.Lock()
+
+
+def get_available_space_mb(path):
+    '''
+    This method returns the space available to us on the filesystem of path in MB,
+    or None if it could not be determined.
+    '''
+
+    try:
+        if platform.system() == 'Windows':
+            import ctypes
+            free_bytes = ctypes.c_ulonglong(0)
+            if not ctypes.windll.kernel32.GetDiskFreeSpaceExW(
+                    ctypes.c_wchar_p(path), ctypes.byref(free_bytes), None, None):
+                raise ctypes.WinError()
+            free_bytes = free_bytes.value
+        else:
+            stats = os.statvfs(path)
+            free_bytes = stats.f_bavail * stats.f_frsize
+    except Exception as e:
+        debugger('[ERROR] Could not get the free space in {}: {}'.format(path, e))
+        return None
+
+    return float(free_bytes) / BYTES_IN_MEGABYTE
+
+
+def wipe_partition_table(device):
+    '''
+    This method overwrites the partition table regions of the device with zeros,
+    such that no stale partition or filesystem is found on it afterwards.
+    Returns whether it succeeded.
+    '''
+
+    zeros = '\0' * WIPE_SIZE
+
+    try:
+        with open(device, 'r+b', 0) as disk:
+            disk.write(zeros)
+
+            # raw devices on some platforms do not report their size, we skip the end then
+            disk.seek(0, os.SEEK_END)
+            size = disk.tell()
+            if size > 2 * WIPE_SIZE:
+                disk.seek(size - WIPE_SIZE)
+                disk.write(zeros)
+
+            os.fsync(disk.fileno())
+    except (IOError, OSError) as e:
+        debugger('[ERROR] Wiping the partition table of {} failed: {}'.format(device, e))
+        return False
+
+    debugger('Wiped the partition table of {}'.format(device))
+    return True
+
+
+def find_program(program):
+    '''
+    This method returns the full path of the program found in the PATH,
+    or None if it is not there. The programs found are kept for the whole session.
+    '''
+
+    with programs_lock:
+        if program in programs_cache:
+            return programs_cache[program]
+
+    # on Windows, programs can be run without their extension e.g. .exe
+    extensions = ['']
+    if platform.system() == 'Windows':
+        extensions += os.environ.get('PATHEXT', '.COM;.EXE;.BAT;.CMD').lower().split(os.pathsep)
+
+    found = None
+    for directory in os.environ.get('PATH', os.defpath).split(os.pathsep):
+        for extension in extensions:
+            path = os.path.join(directory.strip('"'), program + extension)
+            if os.path.isfile(path) and os.access(path, os.X_OK):
+                found = path
+                break
+        if found:
+            break
+
+    if found:
+        with programs_lock:
+            programs_cache[program] = found
+    return found
+
+
+def is_installed(programs_list):
+    '''
+    This method returns whether all the programs are found in the PATH.
+    '''
+
+    missing = [program for program in programs_list if not find_program(program)]
+    if missing:
+        debugger('[ERROR] Could not find {}'.format(', '.join(missing)))
+
+    return not missing
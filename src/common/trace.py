@@ -0,0 +1,187 @@
+#!/usr/bin/env python
+
+# trace.py
+#
+# Copyright (C) 2015 Kano Computing Ltd.
+# License: http://www.gnu.org/licenses/gpl-2.0.txt GNU General Public License v2
+#
+#
+# Timing the steps of a burn
+#
+# When enabled with KANO_BURNER_TRACE=1, the steps of every burn are timed with spans,
+#    with span('unmount', disk=disk_id):
+#        ...
+# and a report with all the spans and the total time spent in each kind of step is
+# written as JSON to ~/.kano-burner/traces when the burn finishes. The debug log is
+# deleted with the temp folder on exit, so the reports are kept separately.
+#
+# Every burn has its own Trace. The jobs of the Scheduler record their spans in the
+# trace of the burn which submitted them, other threads only record spans once they
+# activate() a trace themselves, such that concurrent burns never mix their spans.
+# When tracing is disabled, span() returns the same empty span every time, so the
+# instrumented code does not slow down.
+
+
+import os
+import json
+import time
+import threading
+
+from src.common.paths import traces_path
+
+
+TRACE_BURNS = False
+if os.environ.has_key('KANO_BURNER_TRACE'):
+    TRACE_BURNS = os.environ['KANO_BURNER_TRACE'] == '1'
+
+# the trace of each thread, there is no default shared by the threads
+trace_context = threading.local()
+
+
+class Trace(object):
+    '''
+    This class collects the spans of a single burn.
+    '''
+
+    def __init__(self, label):
+        self.label = label
+        self.start = time.time()
+        self.spans = list()
+        self.lock = threading.Lock()
+
+    def add(self, name, start, duration, attributes, failed=False):
+        record = dict(attributes)
+        record.update({
+            'name': name,
+            'start': round(start - self.start, 3),
+            'duration': round(duration, 3),
+            'thread': threading.current_thread().name
+        })
+        if failed:
+            record['failed'] = True
+
+        with self.lock:
+            self.spans.append(record)
+
+    def getReport(self):
+        with self.lock:
+            spans = sorted(self.spans, key=lambda record: record['start'])
+
+        totals = dict()
+        for record in spans:
+            total = totals.setdefault(record['name'], {'count': 0, 'duration': 0})
+            total['count'] += 1
+            total['duration'] = round(total['duration'] + record['duration'], 3)
+
+        return {
+            'label': self.label,
+            'start': time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(self.start)),
+            'duration': round(time.time() - self.start, 3),
+            'totals': totals,
+            'spans': spans
+        }
+
+    def save(self, directory=traces_path):
+        if not os.path.exists(directory):
+            os.makedirs(directory)
+
+        name = 'trace-{}-{}.json'.format(time.strftime('%Y%m%d-%H%M%S', time.localtime(self.start)),
+                                         ''.join(c if c.isalnum() else '_' for c in self.label))
+        path = os.path.join(directory, name)
+        with open(path, 'w') as report_file:
+            json.dump(self.getReport(), report_file, indent=2, sort_keys=True)
+        return path
+
+
+class Span(object):
+    '''
+    This context manager records the time spent in its block in a trace.
+    '''
+
+    def __init__(self, trace, name, attributes):
+        self.trace = trace
+        self.name = name
+        self.attributes = attributes
+
+    def __enter__(self):
+        self.start = time.time()
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        self.trace.add(self.name, self.start, time.time() - self.start,
+                       self.attributes, failed=exc_type is not None)
+
+
+class NullSpan(object):
+    '''
+    The span used when tracing is disabled, it does nothing.
+    '''
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        pass
+
+
+null_span = NullSpan()
+
+
+def start_trace(label):
+    '''
+    This method starts the trace of a new burn and makes it the current one
+    of the calling thread. Returns None when tracing is disabled.
+    '''
+
+    if not TRACE_BURNS:
+        return None
+
+    trace = Trace(str(label))
+    activate(trace)
+    return trace
+
+
+def activate(trace):
+    trace_context.trace = trace
+
+
+def get_trace():
+    return getattr(trace_context, 'trace', None)
+
+
+def span(name, **attributes):
+    if not TRACE_BURNS:
+        return null_span
+
+    trace = get_trace()
+    if not trace:
+        return null_span
+    return Span(trace, name, attributes)
+
+
+def add_span(name, start, duration, **attributes):
+    # for steps timed by someone else, e.g. the hash check of PySmartDL
+    trace = get_trace() if TRACE_BURNS else None
+    if trace:
+        trace.add(name, start, duration, attributes)
+
+
+def finish_trace(trace):
+    '''
+    This method writes the report of the trace and returns its path,
+    or None if it could not be written.
+    '''
+
+    if not trace:
+        return None
+
+    if getattr(trace_context, 'trace', None) is trace:
+        trace_context.trace = None
+
+    try:
+        return trace.save()
+    except (IOError, OSError) as e:
+        # imported here, utils uses span() for run_cmd()
+        from src.common.utils import debugger
+        debugger('[ERROR] Writing the timing report of {} failed: {}'.format(trace.label, e))
+        return None
@@ -18,13 +18,16 @@ import sys
 import shutil
 import signal
 import subprocess
-from urllib import urlencode
-from urllib2 import urlopen
-from PyQt4 import QtCore
+import Queue
+from urllib2 import HTTPError
 import platform
 import threading
+import time
 
 from src.common.paths import temp_path
+from src.common.logger import LogWriter, format_record, extract_failure_log
+from src.common.trace import span
+from src.common.pySmartDL import connectionpool
 
 
 # Conversion constants
@@ -39,6 +42,26 @@ FEEDBACK_URL = "http://api.kano.me/feedback"
 
 cmd_env = os.environ.copy().update(LC_ALL='C')
 
+# The settings from the environment which could not be parsed, logged once the log is set up
+env_errors = list()
+
+
+def env_number(name, default, convert=int):
+    '''
+    This method returns the number in the environment variable name, or the
+    default if it is not set or not a valid number, e.g. KANO_BURNER_RATE_LIMIT=512K.
+    '''
+
+    if not os.environ.has_key(name):
+        return default
+    try:
+        return convert(os.environ[name])
+    except ValueError:
+        env_errors.append('[ERROR] Ignoring {}={!r}, it is not a number, using {}'
+                          .format(name, os.environ[name], default))
+        return default
+
+
 # The URL used to download information about the lastest OS release
 LATEST_OS_INFO_URL=None
 if os.environ.has_key('KANO_BURNER_TEST_URL'):
@@ -46,6 +69,39 @@ if os.environ.has_key('KANO_BURNER_TEST_URL'):
 else:
     LATEST_OS_INFO_URL = 'http://downloads.kano.me/public/latest.json'
 
+# The range of disk sizes listed for burning in GB, anything outside it is likely
+# a hard drive or a card too small for Kano OS
+MIN_DISK_SIZE = env_number('KANO_BURNER_MIN_DISK_SIZE', 3.5, float)
+
+MAX_DISK_SIZE = env_number('KANO_BURNER_MAX_DISK_SIZE', 16.5, float)
+
+# Whether disks are formatted before burning - the image overwrites the partition
+# table anyway, so by default only the partition table regions are wiped
+FORMAT_BEFORE_BURN = False
+if os.environ.has_key('KANO_BURNER_FORMAT_DISK'):
+    FORMAT_BEFORE_BURN = os.environ['KANO_BURNER_FORMAT_DISK'] == '1'
+
+# How long the result of the internet connection probe is reused, in seconds
+INTERNET_PROBE_TTL = 30
+
+# Optional download bandwidth cap in KB/s, e.g. when sharing a classroom link
+DOWNLOAD_RATE_LIMIT = env_number('KANO_BURNER_RATE_LIMIT', 0)
+
+# Whether the image starts downloading as soon as the dependency checks pass,
+# while the user is still choosing a disk, and its speed cap in KB/s until then
+PREFETCH_IMAGE = False
+if os.environ.has_key('KANO_BURNER_PREFETCH'):
+    PREFETCH_IMAGE = os.environ['KANO_BURNER_PREFETCH'] == '1'
+
+PREFETCH_RATE_LIMIT = env_number('KANO_BURNER_PREFETCH_RATE_LIMIT', 1024)
+
+# Where the metrics for monitoring burn stations are exported, see metrics.py
+METRICS_FILE = None
+if os.environ.has_key('KANO_BURNER_METRICS_FILE'):
+    METRICS_FILE = os.environ['KANO_BURNER_METRICS_FILE']
+
+METRICS_PORT = env_number('KANO_BURNER_METRICS_PORT', 0)
+
 deb_path = None
 logfile = False
 # if we are running from a PyInstaller bundle, print debug to file
@@ -57,50 +113,45 @@ else:
         if platform.system() == 'Darwin':
             deb_path='/dev/tty'
 
+# the log file is written in batches by a background thread
+log_writer = LogWriter(deb_path) if deb_path is not None else None
+
 def debugger(text):
-    global deb_path
-    if deb_path is not None:
-        with open(deb_path, "a") as debug_file:
-            debug_file.write(text + '\n')
-            debug_file.flush()
+    if log_writer is not None:
+        log_writer.write(format_record(text))
+
+        # make sure errors are in the log, even if the app crashes straight after
+        if text.startswith('[ERROR]'):
+            log_writer.flush()
     else:
         print text
         sys.stdout.flush()
 
 
+for message in env_errors:
+    debugger(message)
+
+
 def get_log():
     global logfile, deb_path
     if not logfile:
         # No log file, can't submit errors
         return None
-    try:        
-        return read_file_contents(deb_path)
+    try:
+        # only the part about the last failed burn, such that the report stays small
+        log_writer.flush()
+        return extract_failure_log(deb_path)
     except:
         return None
 
 
-def submit_log(log, email):
-
-    payload = {
-        "text": log,
-        "email": email,
-        "username": "NotApplicable",
-        "category": "Burner",
-        "subject": "Burner failure in version {} on {}".format(BURNER_VERSION, platform.version())
-    }
-    data = urlencode(payload)
-    debugger("URL: "+FEEDBACK_URL+data)
-    content = urlopen(url=FEEDBACK_URL, data=data).read()
-    debugger(content)
-
-
-        
 def run_cmd(cmd):
-    process = subprocess.Popen(cmd, shell=True, env=cmd_env,
-                               stdout=subprocess.PIPE, stderr=subprocess.PIPE,
-                               preexec_fn=restore_signals)
+    with span('cmd', cmd=cmd):
+        process = subprocess.Popen(cmd, shell=True, env=cmd_env,
+                                   stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+                                   preexec_fn=restore_signals)
 
-    stdout, stderr = process.communicate()
+        stdout, stderr = process.communicate()
     return_code = process.returncode
     debugger('ran: [{}] {}'.format(cmd, return_code))
     return stdout, stderr, return_code
@@ -116,10 +167,11 @@ def restore_signals():
 def run_cmd_no_pipe(cmd):
     # used on Windows as there is no support for 'preexec_fn'
     # all handles (in, out, err) need to be set due to PyInstaller bundling
-    process = subprocess.Popen(cmd, shell=True, stdin=subprocess.PIPE,
-                               stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    with span('cmd', cmd=cmd):
+        process = subprocess.Popen(cmd, shell=True, stdin=subprocess.PIPE,
+                                   stdout=subprocess.PIPE, stderr=subprocess.PIPE)
 
-    stdout, stderr = process.communicate()
+        stdout, stderr = process.communicate()
     return_code = process.returncode
     return stdout, stderr, return_code
 
@@ -147,20 +199,58 @@ def write_file_contents(data, path):
         outfile.write(data)
 
 
-def is_internet():
-    url_list = ['http://google.com',
-                'http://twitter.com',
-                'http://facebook.com',
-                'http://youtube.com']
-    for url in url_list:
+def is_internet(timeout=3, attempts=3):
+    '''
+    This method checks whether the server hosting the OS images can be reached.
+
+    HEAD requests to it are started a second apart, or as soon as the previous one
+    failed, without waiting for each other and the first answer within the timeout
+    wins. A successful result is reused for a short while.
+    '''
+
+    if time.time() - internet_probe['time'] < INTERNET_PROBE_TTL:
+        return True
+
+    answers = Queue.Queue()
+    deadline = time.time() + timeout
+
+    def probe():
         try:
-            urlopen(url, timeout=1)
-            return True
+            connectionpool.urlopen(LATEST_OS_INFO_URL, timeout=timeout, method='HEAD').close()
+            answers.put(True)
+        except HTTPError:
+            answers.put(True)  # the server answered, even if with an error
         except Exception as e:
             debugger('internet {}'.format(e))
+            answers.put(False)
+
+    started = failed = 0
+    while failed < attempts:
+        if started < attempts:
+            thread = threading.Thread(target=probe)
+            thread.daemon = True
+            thread.start()
+            started += 1
+
+        try:
+            answer = answers.get(timeout=1 if started < attempts else max(deadline - time.time(), 0))
+        except Queue.Empty:
+            if started < attempts:
+                continue
+            break
+
+        if answer:
+            internet_probe['time'] = time.time()
+            return True
+        failed += 1
+
     return False
 
 
+# the time of the last successful internet probe
+internet_probe = {'time': 0}
+
+
 def load_css_for_widget(widget, css_path, res_path=''):
     '''
     This method is used to set CSS styling for a given
@@ -172,6 +262,9 @@ def load_css_for_widget(widget, css_path, res_path=''):
     NOTE: It assumes only one {res_path} string will be on a single line.
     '''
 
+    # imported here such that the command line burner does not need PyQt
+    from PyQt4 import QtCore
+
     css = QtCore.QFile(css_path)
     css.open(QtCore.QIODevice.ReadOnly)
     if css.isOpen():
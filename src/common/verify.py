@@ -0,0 +1,99 @@
+#!/usr/bin/env python
+
+# verify.py
+#
+# Copyright (C) 2015 Kano Computing Ltd.
+# License: http://www.gnu.org/licenses/gpl-2.0.txt GNU General Public License v2
+#
+#
+# Verifying a burned disk
+#
+# After burning, we read the disk back and compare it with the uncompressed
+# image, such that a faulty card is found before it is handed out. On Linux,
+# the pages dd has just written are dropped from the cache first, otherwise
+# we would be comparing the image with itself.
+
+
+import os
+import time
+import gzip
+import ctypes
+import ctypes.util
+import platform
+
+from src.common.utils import debugger, calculate_eta, BYTES_IN_MEGABYTE
+from src.common.errors import VERIFY_ERROR, CANCELLED_ERROR
+from src.common.paths import temp_path
+
+
+# The disk is read in chunks of this size, a multiple of any sector size
+VERIFY_CHUNK_SIZE = 4 * 1024 * 1024
+
+# see fcntl.h
+POSIX_FADV_DONTNEED = 4
+
+
+def verify_burn(os_info, disk_id, report_progress_ui, cancelled=None):
+    '''
+    This method compares the contents of the disk with the image burned on it.
+    It returns an error if they differ or the disk could not be read.
+    The verifying is stopped if the cancelled event is set.
+    '''
+
+    report_progress_ui(0, 'preparing to verify OS image..')
+
+    image_path = os.path.join(temp_path, os_info['archive'])
+    size = os_info['uncompressed_size']
+    position = 0
+
+    try:
+        with gzip.open(image_path, 'rb') as image, open(get_device_path(disk_id), 'rb') as disk:
+            drop_cache(disk)
+            start = time.time()
+
+            while True:
+                if cancelled and cancelled.is_set():
+                    debugger('Verifying {} cancelled'.format(disk_id))
+                    return CANCELLED_ERROR
+
+                expected = image.read(VERIFY_CHUNK_SIZE)
+                if not expected:
+                    break
+
+                # raw devices need whole sectors to be read, the last chunk may be shorter
+                if disk.read(VERIFY_CHUNK_SIZE)[:len(expected)] != expected:
+                    debugger('[ERROR] Disk {} differs from the image at {}'.format(disk_id, position))
+                    return VERIFY_ERROR
+                position += len(expected)
+
+                speed = position / max(time.time() - start, 0.001)
+                progress = int(float(position) / size * 100)
+                report_progress_ui(progress, 'speed {0:.2f} MB/s  eta {1:s}  completed {2:d}%'
+                                   .format(speed / BYTES_IN_MEGABYTE, calculate_eta(position, size, speed), progress))
+
+    except (IOError, OSError) as e:
+        debugger('[ERROR] Verifying {} failed: {}'.format(disk_id, e))
+        return VERIFY_ERROR
+
+    debugger('Verified {} MB on {}'.format(position / BYTES_IN_MEGABYTE, disk_id))
+    report_progress_ui(100, 'verifying finished successfully')
+    return None
+
+
+def get_device_path(disk_id):
+    # on Windows, the disk id is a dict and the drive is read as \\.\PHYSICALDRIVE[id]
+    if isinstance(disk_id, dict):
+        return '\\\\.\\PHYSICALDRIVE{}'.format(disk_id['id_num'])
+    return disk_id
+
+
+def drop_cache(disk):
+    if platform.system() != 'Linux':
+        return
+
+    try:
+        libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6', use_errno=True)
+        os.fsync(disk.fileno())
+        libc.posix_fadvise(disk.fileno(), ctypes.c_longlong(0), ctypes.c_longlong(0), POSIX_FADV_DONTNEED)
+    except Exception as e:
+        debugger('[ERROR] Could not drop the cache of the disk: {}'.format(e))
@@ -15,7 +15,8 @@
 #    need for uncompressing the image and extra space needed.
 #
 # The polling thread sends a signal to dd which triggers it to output
-#    its progress to stderr in the form of 'X bytes written'.
+#    its progress to stderr in the form of 'X bytes written'. Only the dd
+#    started for this burn is signalled, as several disks may be burned at once.
 #
 # We will also notify the UI of any errors that might have occured.
 
@@ -23,65 +24,110 @@
 import os
 import time
 import Queue
+import signal
 import threading
 import subprocess
 
-from src.common.utils import run_cmd, calculate_eta, debugger
+from src.common.utils import calculate_eta, debugger
 from src.common.utils import BYTES_IN_MEGABYTE, cmd_env
-from src.common.errors import BURN_ERROR
+from src.common.errors import BURN_ERROR, CANCELLED_ERROR
 from src.common.paths import temp_path
 
 final_message = "PLEASE EJECT THE SD CARD!"
 
 
-def start_burn_process(os_info, disk, report_progress_ui):
+def extract_kano_os(os_info, report_progress_ui):
+    '''
+    This method is used by the backendThread before burning any disk.
+
+    The image is decompressed while it is burned, so there is nothing to do.
+    '''
+
+    return None
+
+
+def start_burn_process(os_info, disk, report_progress_ui, cancelled=None):
     '''
     This method is used by the backendThread to burn Kano OS.
 
     It starts the burning process on a separate thread and then
     sits in the polling loop. It uses a Queue to get results from
     the burning thread and returns an error if necessary.
+    The burning is stopped if the cancelled event is set.
     '''
 
     # Set the progress to 0% on the UI progressbar, and write what we're up to
     report_progress_ui(0, 'preparing to burn OS image..')
 
+    try:
+        gzip_process, dd_process = start_burn_pipe(os.path.join(temp_path, os_info['filename']), disk)
+    except OSError as e:
+        debugger('[ERROR] Starting the burning process failed: {}'.format(e))
+        return BURN_ERROR
+
     # since a thread cannot return, use this queue to add the return boolean
     thread_output = Queue.Queue()
 
-    # start the burning process on a separate thread and such that this one polls for progress
+    # read the progress of dd on a separate thread and such that this one polls for progress
     burn_thread = threading.Thread(target=burn_kano_os,
-                                   args=(os.path.join(temp_path, os_info['filename']),
-                                         disk,
+                                   args=(gzip_process,
+                                         dd_process,
                                          os_info['uncompressed_size'],
                                          thread_output,
                                          report_progress_ui))
     burn_thread.start()
 
     # start the polling loop and pass the reference of the burning thread
-    poll_burning_thread(burn_thread)
+    poll_burning_thread(burn_thread, dd_process, cancelled)
 
-    # make sure we clean up threading resources
+    # make sure we clean up threading resources, dd is only reaped
+    # now such that its pid cannot be reused while it is signalled
     burn_thread.join()
-
     successful = thread_output.get()
+    dd_process.wait()
+    gzip_process.wait()
+
+    if cancelled and cancelled.is_set():
+        debugger('Burning {} cancelled'.format(disk))
+        return CANCELLED_ERROR
+
+    if dd_process.returncode:
+        debugger('[ERROR] dd returned error code {}'.format(dd_process.returncode))
+        successful = False
+
+    # gzip returns 2 for warnings, e.g. trailing garbage
+    if gzip_process.returncode == 1:
+        debugger('[ERROR] gzip returned error code {}'.format(gzip_process.returncode))
+        successful = False
+
     if not successful:
+        debugger('[ERROR] Burning Kano image failed')
         return BURN_ERROR
     else:
+        debugger('Burning successfully finished')
         return None
 
 
-def burn_kano_os(path, disk, size, return_queue, report_progress_ui):
-    cmd = 'gzip -dc {} | dd of={} bs=4M'.format(path, disk)
-    process = subprocess.Popen(cmd, shell=True, env=cmd_env, stderr=subprocess.PIPE)
+def start_burn_pipe(path, disk):
+    # gzip decompresses the image straight into dd, without a shell in between
+    # such that we know the pid of dd
+    gzip_process = subprocess.Popen(['gzip', '-dc', path], env=cmd_env,
+                                    stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    dd_process = subprocess.Popen(['dd', 'of={}'.format(disk), 'bs=4M'], env=cmd_env,
+                                  stdin=gzip_process.stdout, stderr=subprocess.PIPE)
+    gzip_process.stdout.close()
+
+    return gzip_process, dd_process
 
+
+def burn_kano_os(gzip_process, dd_process, size, return_queue, report_progress_ui):
     failed = False
     unparsed_line = ''
 
     # as long as Popen is running, read it's stderr line by line
     # each time a USR1 signal is sent to dd, it outputs 3 lines
     # and we are only interested in the last one i.e. 'x bytes written in y seconds'
-    for line in iter(process.stderr.readline, ''):
+    for line in iter(dd_process.stderr.readline, ''):
         if 'bytes' in line:
             try:
                 parts = line.split()
@@ -103,6 +149,12 @@ def burn_kano_os(path, disk, size, return_queue, report_progress_ui):
             debugger('[ERROR] ' + line)
             failed = True
 
+    # and from gzip, e.g. a corrupted image
+    for line in gzip_process.stderr:
+        debugger('[ERROR] ' + line)
+        if 'error' in line.lower() or 'invalid' in line.lower():
+            failed = True
+
     # make sure the progress bar is filled and show an appropriate message
     # if we failed, the UI will immediately show the error screen
     report_progress_ui(100, 'burning finished successfully')
@@ -111,25 +163,25 @@ def burn_kano_os(path, disk, size, return_queue, report_progress_ui):
     if unparsed_line:
         debugger('[ERROR] Failed parsing the line: ' + unparsed_line)
 
-    if failed:
-        debugger('[ERROR] Burning Kano image failed')
-        return_queue.put(False)
-    else:
-        debugger('Burning successfully finished')
-        return_queue.put(True)
+    return_queue.put(not failed)
 
 
-def poll_burning_thread(thread):
-    time.sleep(1)  # wait for dd to start
+def poll_burning_thread(thread, dd_process, cancelled=None):
+    time.sleep(1)  # wait for dd to start, the signal would kill it before
     debugger('Polling burner for progress..')
-    cmd = 'kill -USR1 `pgrep ^dd`'
 
     # as long as the burning thread is running, send SIGUSR1
     # to dd to trigger progress output
     while thread.is_alive():
-        _, error, return_code = run_cmd(cmd)
-        if return_code:
-            debugger('[ERROR] Sending signal to burning thread failed')
+        if cancelled and cancelled.is_set():
+            debugger('Stopping dd, the burning was cancelled')
+            dd_process.kill()
+            return False
+
+        try:
+            os.kill(dd_process.pid, signal.SIGUSR1)
+        except OSError as e:
+            debugger('[ERROR] Sending signal to burning thread failed: {}'.format(e))
             return False
         time.sleep(0.3)
     return True
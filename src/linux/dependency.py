@@ -11,15 +11,17 @@
 # The application needs to meet a few dependencies before
 # it can have the green light to start.
 #
-# Firstly, we check that the necessary tools are installed, e.g. dd, gzip
-# Secondly, we check that there is an internet connection.
-# And finally, we make sure there is enough space to download the OS.
+# We check that there is an internet connection, that the necessary tools
+# are installed, e.g. dd, gzip, and that there is enough space to download the OS.
+# These checks are independent, so they all run at the same time.
 
 
 import math
 
 from src.common.download import get_latest_os_info
-from src.common.utils import run_cmd, is_internet, debugger, BYTES_IN_MEGABYTE
+from src.common.utils import is_internet, debugger, BYTES_IN_MEGABYTE
+from src.common.checks import Check, run_checks
+from src.common.system import is_installed, get_available_space_mb
 from src.common.errors import INTERNET_ERROR, TOOLS_ERROR, SERVER_DOWN_ERROR, FREE_SPACE_ERROR
 from src.common.paths import temp_path
 
@@ -35,28 +37,36 @@ def check_dependencies():
     of the application and on a retry.
     '''
 
+    # running all checks concurrently, each with its own timeout in seconds
+    results = run_checks([
+        Check('internet', is_internet, timeout=10, default=False),
+        Check('tools', verify_tools, timeout=5, default=True),
+        Check('required space', get_required_mb, timeout=15),
+        Check('free space', get_free_space_mb, timeout=5)
+    ])
+
     # looking for an internet connection
-    if is_internet():
+    if results['internet']:
         debugger('Internet connection detected')
     else:
         debugger('No internet connection found')
         return INTERNET_ERROR
 
     # checking all necessary tools are installed
-    if verify_tools():
+    if results['tools']:
         debugger('All necessary tools have been found')
     else:
         debugger('[ERROR] Not all tools are present')
         return TOOLS_ERROR
 
     # grabbing the required amount of free space from the servers
-    required_mb = get_required_mb()
+    required_mb = results['required space']
     if not required_mb:
         debugger('[ERROR] Could not reach server, they may be down')
         return SERVER_DOWN_ERROR
 
     # making sure we have enough space to download OS
-    if is_sufficient_space(required_mb):
+    if is_sufficient_space(required_mb, results['free space']):
         debugger('Sufficient available space (min {} MB)'.format(required_mb))
     else:
         debugger('Insufficient available space (min {} MB)'.format(required_mb))
@@ -71,33 +81,18 @@ def verify_tools():
     tools = """
         awk
         dd
-        df
         eject
-        fdisk
         grep
         gzip
         kill
-        mkdosfs
         parted
         pgrep
-        umount
     """
 
     # return whether we have found all tools
     return is_installed(tools.split())
 
 
-def is_installed(programs_list):
-    cmd = 'which {}'.format(' '.join(programs_list))
-    output, error, return_code = run_cmd(cmd)
-
-    if return_code:
-        debugger('[ERROR] ' + error.strip('\n'))
-        return True  # if something goes wrong here, it shouldn't be catastrophic
-
-    return len(output.split()) == len(programs_list)
-
-
 def get_required_mb():
     os_info = get_latest_os_info()
     if not os_info:
@@ -112,15 +107,16 @@ def get_required_mb():
     return required_mb
 
 
-def is_sufficient_space(required_mb):
-    cmd = "df %s | grep -v 'Available' | awk '{print $4}'" % temp_path
-    output, _, _ = run_cmd(cmd)
+def get_free_space_mb():
+    free_space_mb = get_available_space_mb(temp_path)
+    if free_space_mb is not None:
+        debugger('Free space {0:.2f} MB in {1}'.format(free_space_mb, temp_path))
+
+    return free_space_mb
+
 
-    try:
-        free_space_mb = float(output.strip()) * 512 / BYTES_IN_MEGABYTE
-    except:
-        debugger('[ERROR] Failed parsing the line ' + output)
-        return True
+def is_sufficient_space(required_mb, free_space_mb):
+    if free_space_mb is None:
+        return True  # if we could not measure it, we let the burning process try
 
-    debugger('Free space {0:.2f} MB in {1}'.format(free_space_mb, temp_path))
     return free_space_mb > required_mb
@@ -12,14 +12,29 @@
 #
 # 1. Providing a list of disks Kano OS can be burned to. We will exclude
 #    any potential hard drives from this list or disks which are too small.
+#    The disks are read from sysfs, which does not touch the devices themselves.
 #
-# 2. Preparing the given disk for the burning process (unmounting, formatting).
+# 2. Preparing the given disk for the burning process (unmounting, wiping
+#    the partition table or optionally formatting).
 #
-# Tools used: parted, fdisk, mkdosfs, umount, eject
+# Tools used: parted (only without sysfs), mkdosfs (optional), eject
 
 
-from src.common.utils import run_cmd, debugger, BYTES_IN_GIGABYTE
-from src.common.errors import UNMOUNT_ERROR
+import os
+
+from src.common.utils import run_cmd, debugger, read_file_contents, BYTES_IN_GIGABYTE
+from src.common.utils import MIN_DISK_SIZE, MAX_DISK_SIZE, FORMAT_BEFORE_BURN
+from src.common.system import wipe_partition_table
+from src.common.disk_probe import DiskProber
+from src.common.trace import span
+from src.linux.mounts import get_disk_mounts, unmount_all
+from src.common.errors import UNMOUNT_ERROR, WIPE_ERROR
+
+
+SYSFS_BLOCK_PATH = '/sys/block'
+
+# sysfs always reports sizes in 512 byte sectors, whatever the device uses
+SYSFS_SECTOR_SIZE = 512
 
 
 class unmount_error(Exception):
@@ -28,10 +43,10 @@ class unmount_error(Exception):
 
 def get_disks_list():
     '''
-    This method is used by the BurnerGUI when the user clicks the ComboBox.
+    This method is used by the DiskMonitor to keep the list of disks up to date.
 
-    It grabs all disk ids, disk names, and disk sizes separately and then
-    matches them by index. Sizes will be converted to GB (not GiB).
+    It reads all disk ids, disk names, and disk sizes from sysfs in a single pass,
+    falling back to asking parted for each disk. Sizes will be converted to GB (not GiB).
 
     NOTE: We do no return all disks that are found!
 
@@ -39,23 +54,21 @@ def get_disks_list():
         disk id: /dev/sda
         disk name: Sandisk Ultra USB
         disk size: 16.03
+        disk serial: 4C530001190124102155 (only read from sysfs)
+        disk removable: True (only read from sysfs)
     '''
 
     disks = list()
 
-    for disk_id in get_disk_ids():
+    if os.path.isdir(SYSFS_BLOCK_PATH):
+        found_disks = get_sysfs_disks()
+    else:
+        found_disks = get_parted_disks()
 
-        # get the disk manufacturer and size in GB
-        disk_name, disk_size = get_disk_name_size(disk_id)
-
-        disk = {
-            'id': disk_id,
-            'name': disk_name,
-            'size': disk_size
-        }
+    for disk in found_disks:
 
         # make sure we do not list any potential hard drive or too small SD card
-        if disk['size'] < 3.5 or disk['size'] > 16.5:  # GB
+        if disk['size'] < MIN_DISK_SIZE or disk['size'] > MAX_DISK_SIZE:  # GB
             debugger('Ignoring {}'.format(disk))
         else:
             debugger('Listing {}'.format(disk))
@@ -64,6 +77,102 @@ def get_disks_list():
     return disks
 
 
+def get_sysfs_disks():
+    '''
+    This method lists the disks found in /sys/block without spawning
+    any process or reading from the devices.
+    '''
+
+    disks = list()
+
+    for device in sorted(os.listdir(SYSFS_BLOCK_PATH)):
+        device_path = os.path.realpath(os.path.join(SYSFS_BLOCK_PATH, device))
+
+        # loop, ram, zram, device mapper etc. are not real disks
+        if '/virtual/' in device_path:
+            continue
+
+        # DVD drives (SCSI type 5) and write-protected cards cannot be burned
+        if read_sysfs_attribute(device_path, 'device/type') == '5':
+            debugger('Ignoring optical drive {}'.format(device))
+            continue
+        if read_sysfs_attribute(device_path, 'ro') == '1':
+            debugger('Ignoring read-only disk {}'.format(device))
+            continue
+
+        try:
+            sectors = int(read_sysfs_attribute(device_path, 'size'))
+        except ValueError:
+            debugger('[ERROR] Reading the size of {} failed'.format(device))
+            continue
+
+        # the disk name is the vendor and model, e.g. 'Generic STORAGE DEVICE (usb)'
+        # SD cards in built-in readers only have a name instead
+        vendor = read_sysfs_attribute(device_path, 'device/vendor')
+        model = read_sysfs_attribute(device_path, 'device/model') or \
+            read_sysfs_attribute(device_path, 'device/name')
+        transport = get_sysfs_transport(device_path)
+        name = ' '.join([part for part in [vendor, model] if part])
+        if transport:
+            name = '{} ({})'.format(name, transport)
+
+        # built-in SD card readers report their cards as not removable
+        disk = {
+            'id': '/dev/{}'.format(device.replace('!', '/')),
+            'name': name,
+            'size': float(sectors * SYSFS_SECTOR_SIZE) / BYTES_IN_GIGABYTE,
+            'serial': get_sysfs_serial(device_path),
+            'removable': read_sysfs_attribute(device_path, 'removable') == '1' or transport == 'sd/mmc'
+        }
+
+        disks.append(disk)
+
+    return disks
+
+
+def read_sysfs_attribute(device_path, attribute):
+    try:
+        return (read_file_contents(os.path.join(device_path, attribute)) or '').strip()
+    except (IOError, OSError):
+        return ''
+
+
+def get_sysfs_serial(device_path):
+    # SD cards have their own serial, USB readers have it on the USB device
+    # a few levels up the device tree, e.g. /sys/devices/.../usb2/2-1/serial
+    path = os.path.realpath(os.path.join(device_path, 'device'))
+    while path.startswith('/sys/devices/'):
+        serial = read_sysfs_attribute(path, 'serial')
+        if serial:
+            return serial
+        path = os.path.dirname(path)
+    return ''
+
+
+def get_sysfs_transport(device_path):
+    # the bus the disk is on is part of its path in the device tree, e.g.
+    # /sys/devices/pci0000:00/0000:00:14.0/usb2/2-1/2-1:1.0/host6/.../block/sdb
+    for bus, transport in [('/usb', 'usb'), ('/mmc', 'sd/mmc'), ('/ata', 'ata'),
+                           ('/nvme', 'nvme'), ('/virtio', 'virtblk')]:
+        if bus in device_path:
+            return transport
+    return ''
+
+
+def get_parted_disks():
+    disks = list()
+
+    # get the disk manufacturer and size in GB, probing a few disks at a time
+    for disk_id, (disk_name, disk_size) in disk_prober.probe_disks(get_disk_ids()):
+        disks.append({
+            'id': disk_id,
+            'name': disk_name,
+            'size': disk_size
+        })
+
+    return disks
+
+
 def get_disk_ids():
     cmd = "parted --list | grep 'Disk /dev/.*:' | awk '{print $2}'"
     output, error, return_code = run_cmd(cmd)
@@ -100,50 +209,57 @@ def get_disk_name_size(disk_id):
     return disk_name, disk_size
 
 
+disk_prober = DiskProber(get_disk_name_size)
+
+
+def get_device_name(disk_id):
+    '''
+    This method returns a stable name for the disk, used to tell disks apart
+    in the scheduler, the traces and the metrics e.g. /dev/sdb
+    '''
+
+    return disk_id
+
+
 def prepare_disk(disk_id, report_ui):
     '''
     This method is used by the backendThread to unmount
-    and format the disk before the burning process starts.
+    and wipe the disk before the burning process starts.
     '''
 
     try:
         report_ui('unmounting disk')
-        unmount_disk(disk_id)
-
-        report_ui('formating disk')
-        format_disk(disk_id)
+        with span('unmount', disk=disk_id):
+            unmount_disk(disk_id)
+
+        # the image overwrites the partition table anyway, formatting is rarely needed
+        if FORMAT_BEFORE_BURN:
+            report_ui('formating disk')
+            with span('format', disk=disk_id):
+                format_disk(disk_id)
+        else:
+            report_ui('wiping disk')
+            with span('wipe', disk=disk_id):
+                if not wipe_partition_table(disk_id):
+                    return WIPE_ERROR
     except unmount_error:
         return UNMOUNT_ERROR
 
 
 def unmount_disk(disk_id):
-    # to unmount an entire disk, we first need to unmount all it's volumes
-    unmount_volumes(disk_id)
-
-    # now we can safely unmount the disk
-    cmd = 'umount {}'.format(disk_id)
-    _, error, return_code = run_cmd(cmd)
-    if not return_code:
-        debugger('disk {} successfully unmounted'.format(disk_id))
-    else:
-        debugger('[ERROR] ' + error.strip('\n'))
+    # find exactly the mounts of the disk and its partitions in the mount table
+    mount_points = get_disk_mounts(disk_id)
+    if not mount_points:
+        debugger('disk {} is not mounted'.format(disk_id))
+        return
+
+    # unmount them all at the same time and make sure none is left
+    failed = unmount_all(mount_points)
+    if failed:
+        debugger('[ERROR] Could not unmount {}'.format(', '.join(failed)))
         raise unmount_error
 
-
-def unmount_volumes(disk_id):
-    # all volumes on a disk have an index attached e.g. /dev/sdb1, /dev/sdb2
-    cmd = "fdisk -l | grep '%s[0-9][0-9]*' | awk '{print $1}'" % disk_id
-    output, _, _ = run_cmd(cmd)
-
-    # it may also happen that the disk does not have volumes
-    # in which case the loop below won't do anything
-    for volume in output.splitlines():
-        cmd = 'umount {}'.format(volume)
-        _, error, return_code = run_cmd(cmd)
-        if not return_code:
-            debugger('volume {} successfully unmounted'.format(volume))
-        else:
-            debugger('[ERROR] ' + error.strip('\n'))
+    debugger('disk {} successfully unmounted'.format(disk_id))
 
 
 def format_disk(disk_id):
@@ -0,0 +1,161 @@
+#!/usr/bin/env python
+
+# mounts.py
+#
+# Copyright (C) 2015 Kano Computing Ltd.
+# License: http://www.gnu.org/licenses/gpl-2.0.txt GNU General Public License v2
+#
+#
+# Linux - Finding and unmounting the mounts of a disk
+#
+# The mount table in /proc/self/mountinfo lists the device number of every mount,
+# so we can find exactly the mounts of a disk and its partitions, however they
+# were mounted, e.g. through a /dev/disk/by-uuid symlink. They are then unmounted
+# in-process with umount2(), all at the same time and with a timeout.
+
+
+import os
+import time
+import ctypes
+import ctypes.util
+import threading
+
+from src.common.utils import debugger
+
+
+MOUNTINFO_PATH = '/proc/self/mountinfo'
+
+# How long a single unmount may take, in seconds
+UNMOUNT_TIMEOUT = 10
+
+
+def get_device_numbers(disk_id):
+    '''
+    This method returns the 'major:minor' device numbers of the disk
+    and all of its partitions, read from sysfs.
+    '''
+
+    name = os.path.basename(os.path.realpath(disk_id))
+    sysfs_path = os.path.join('/sys/class/block', name)
+
+    numbers = set()
+    for path in [sysfs_path] + [os.path.join(sysfs_path, entry) for entry in os.listdir(sysfs_path)]:
+        try:
+            with open(os.path.join(path, 'dev')) as dev_file:
+                numbers.add(dev_file.read().strip())
+        except IOError:
+            pass  # not a partition
+
+    return numbers
+
+
+def get_disk_mounts(disk_id):
+    '''
+    This method returns the mount points of the disk and its partitions,
+    the deepest ones first, such that nested mounts are unmounted first.
+    '''
+
+    try:
+        numbers = get_device_numbers(disk_id)
+    except OSError as e:
+        debugger('[ERROR] Reading the partitions of {} failed: {}'.format(disk_id, e))
+        numbers = set()
+
+    disk_path = os.path.realpath(disk_id)
+    mounts = list()
+
+    with open(MOUNTINFO_PATH) as mountinfo:
+        for line in mountinfo:
+            # e.g. 36 25 8:17 / /media/user/boot rw,relatime shared:1 - vfat /dev/sdb1 rw
+            fields = line.split()
+            separator = fields.index('-', 6)
+            number, mount_point, source = fields[2], fields[4], fields[separator + 2]
+
+            # the device numbers cover symlinks and renamed device nodes, the source
+            # path is only a fallback for when sysfs is not there
+            source_path = os.path.realpath(source) if source.startswith('/') else source
+            if number in numbers or (not numbers and is_partition_of(source_path, disk_path)):
+                mount_point = decode_mount_point(mount_point)
+                if mount_point not in mounts:
+                    mounts.append(mount_point)
+
+    return sorted(mounts, key=lambda mount: mount.count('/'), reverse=True)
+
+
+def is_partition_of(device, disk):
+    # e.g. /dev/sdb1 of /dev/sdb, or /dev/mmcblk0p1 of /dev/mmcblk0
+    if device == disk:
+        return True
+
+    suffix = device[len(disk):] if device.startswith(disk) else ''
+    return suffix.lstrip('p').isdigit()
+
+
+def decode_mount_point(mount_point):
+    # spaces, tabs, newlines and backslashes are escaped in octal, e.g. '\040'
+    for escaped in ['\\040', '\\011', '\\012', '\\134']:
+        mount_point = mount_point.replace(escaped, chr(int(escaped[1:], 8)))
+    return mount_point
+
+
+def unmount_all(mount_points, timeout=UNMOUNT_TIMEOUT):
+    '''
+    This method unmounts all the given mount points concurrently, with mount points
+    nested in others being unmounted first. Returns the ones which failed.
+    '''
+
+    failed = list()
+
+    # group the mount points by depth, the deepest first, as given by get_disk_mounts()
+    depths = sorted(set([mount.count('/') for mount in mount_points]), reverse=True)
+    for depth in depths:
+        threads = list()
+        for mount_point in [mount for mount in mount_points if mount.count('/') == depth]:
+            thread = UnmountThread(mount_point)
+            thread.start()
+            threads.append(thread)
+
+        deadline = time.time() + timeout
+        for thread in threads:
+            thread.join(max(deadline - time.time(), 0))
+
+            if thread.duration is None:
+                debugger('[ERROR] Unmounting {} timed out'.format(thread.mount_point))
+                failed.append(thread.mount_point)
+            elif thread.error:
+                debugger('[ERROR] Unmounting {} failed: {}'.format(thread.mount_point, thread.error))
+                failed.append(thread.mount_point)
+            else:
+                debugger('{} successfully unmounted in {:.2f}s'.format(thread.mount_point, thread.duration))
+
+    return failed
+
+
+class UnmountThread(threading.Thread):
+    '''
+    This daemon thread unmounts a single mount point, such that
+    a hung unmount cannot block the burning process.
+    '''
+
+    def __init__(self, mount_point):
+        super(UnmountThread, self).__init__()
+        self.daemon = True
+
+        self.mount_point = mount_point
+        self.error = None
+        self.duration = None
+
+    def run(self):
+        start = time.time()
+        self.error = umount(self.mount_point)
+        self.duration = time.time() - start
+
+
+def umount(mount_point):
+    # returns the error message, or None on success
+    if libc.umount2(mount_point, 0) == 0:
+        return None
+    return os.strerror(ctypes.get_errno())
+
+
+libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6', use_errno=True)
@@ -13,13 +13,18 @@
 # 1. Providing a list of disks Kano OS can be burned to. We will exclude
 #    any potential hard drives from this list or disks which are too small.
 #
-# 2. Preparing the given disk for the burning process (unmounting, formatting).
+# 2. Preparing the given disk for the burning process (unmounting, wiping
+#    the partition table or optionally formatting).
 #
 # Tools used: diskutil
 
 
 from src.common.utils import run_cmd, debugger, BYTES_IN_GIGABYTE
-from src.common.errors import UNMOUNT_ERROR, FORMAT_ERROR, EJECT_ERROR
+from src.common.utils import MIN_DISK_SIZE, MAX_DISK_SIZE, FORMAT_BEFORE_BURN
+from src.common.system import wipe_partition_table
+from src.common.disk_probe import DiskProber
+from src.common.trace import span
+from src.common.errors import UNMOUNT_ERROR, FORMAT_ERROR, WIPE_ERROR, EJECT_ERROR
 
 
 class disk_error(Exception):
@@ -28,10 +33,10 @@ class disk_error(Exception):
 
 def get_disks_list():
     '''
-    This method is used by the BurnerGUI when the user clicks the ComboBox.
+    This method is used by the DiskMonitor to keep the list of disks up to date.
 
-    It grabs all disk ids and then for every disk we get the name and size.
-    Sizes will be converted to GB (not GiB).
+    It grabs all disk ids and then for every disk we get the name and size,
+    probing a few disks at a time. Sizes will be converted to GB (not GiB).
 
     NOTE: We do no return all disks that are found!
 
@@ -43,13 +48,11 @@ def get_disks_list():
 
     disks = list()
 
-    for disk_id in get_disk_ids():
+    # change disks to raw to increase performance
+    disk_ids = [disk_id[:5] + 'r' + disk_id[5:] for disk_id in get_disk_ids() or []]
 
-        # change disk to raw to increase performance
-        disk_id = disk_id[:5] + 'r' + disk_id[5:]
-
-        # get the disk manufacturer and size in GB
-        disk_name, disk_size = get_disk_name_size(disk_id)
+    # get the disk manufacturer and size in GB
+    for disk_id, (disk_name, disk_size) in disk_prober.probe_disks(disk_ids):
 
         disk = {
             'id': disk_id,
@@ -58,7 +61,7 @@ def get_disks_list():
         }
 
         # make sure we do not list any potential hard drive or too small SD card
-        if disk['size'] < 3.5 or disk['size'] > 16.5:  # GB
+        if disk['size'] < MIN_DISK_SIZE or disk['size'] > MAX_DISK_SIZE:  # GB
             debugger('Ignoring {}'.format(disk))
         else:
             debugger('Listing {}'.format(disk))
@@ -99,22 +102,44 @@ def get_disk_name_size(disk_id):
     return disk_name, disk_size
 
 
+disk_prober = DiskProber(get_disk_name_size)
+
+
+def get_device_name(disk_id):
+    '''
+    This method returns a stable name for the disk, used to tell disks apart
+    in the scheduler, the traces and the metrics e.g. /dev/rdisk2
+    '''
+
+    return disk_id
+
+
 def prepare_disk(disk_id, report_ui):
     '''
     This method is used by the backendThread to unmount
-    and format the disk before the burning process starts.
+    and wipe the disk before the burning process starts.
     '''
 
     try:
         report_ui('unmounting disk')
-        unmount_disk(disk_id)
-
-        report_ui('formating disk')
-        format_disk(disk_id)
-
-        # OSX mounts the disk back after formatting
-        report_ui('unmounting disk')
-        unmount_disk(disk_id)
+        with span('unmount', disk=disk_id):
+            unmount_disk(disk_id)
+
+        # the image overwrites the partition table anyway, formatting is rarely needed
+        if FORMAT_BEFORE_BURN:
+            report_ui('formating disk')
+            with span('format', disk=disk_id):
+                format_disk(disk_id)
+
+            # OSX mounts the disk back after formatting
+            report_ui('unmounting disk')
+            with span('unmount', disk=disk_id):
+                unmount_disk(disk_id)
+        else:
+            report_ui('wiping disk')
+            with span('wipe', disk=disk_id):
+                if not wipe_partition_table(disk_id):
+                    raise disk_error(WIPE_ERROR)
     except disk_error as e:
         return e.args[0]
 
@@ -14,6 +14,9 @@
 # As opposed to OSX and Linux versions of dd, here do not need a polling loop.
 # However, dd does not report its writing speed, so we time it ourselves.
 #
+# The archive is unzipped once by extract_kano_os() before any disk is burned,
+# as several disks may be burned from the same image at the same time.
+#
 # We will also notify the UI of any errors that might have occured.
 
 
@@ -22,29 +25,47 @@ import time
 import subprocess
 
 from src.common.utils import run_cmd_no_pipe, calculate_eta, debugger, BYTES_IN_MEGABYTE
-from src.common.errors import BURN_ERROR
+from src.common.errors import BURN_ERROR, CANCELLED_ERROR
 from src.common.paths import _7zip_path, _dd_path, temp_path
 
 
-# used to calculate burning speed
-last_written_mb = 0
-
 final_message = ""
 
 
-def start_burn_process(os_info, disk, report_progress_ui):
+def extract_kano_os(os_info, report_progress_ui):
     '''
-    This method is used by the backendThread to burn Kano OS.
+    This method is used by the backendThread before burning any disk.
 
-    It starts the burning process and returns any errors if necessary.
+    It unzips the archive once, such that the disks are all burned from the same image.
     '''
 
+    os_path = os.path.join(temp_path, os_info['filename'])
+    if os.path.isfile(os_path) and os.path.getsize(os_path) == os_info['uncompressed_size']:
+        debugger('Kano OS is already unzipped')
+        return None
+
     # Set the progress to 0% on the UI progressbar, and write what we're up to
     report_progress_ui(0, 'unzipping Kano OS archive..')
 
-    # unzip the archive before burning
     os_archive = os.path.join(temp_path, os_info['archive'])
-    unzip_kano_os(os_archive, temp_path)
+    if not unzip_kano_os(os_archive, temp_path):
+        return BURN_ERROR
+
+    report_progress_ui(100, 'unzipping finished successfully')
+    return None
+
+
+def start_burn_process(os_info, disk, report_progress_ui, cancelled=None):
+    '''
+    This method is used by the backendThread to burn Kano OS.
+
+    It starts the burning process and returns any errors if necessary.
+    The image must have been unzipped by extract_kano_os() already.
+    The burning is stopped if the cancelled event is set.
+    '''
+
+    # Set the progress to 0% on the UI progressbar, and write what we're up to
+    report_progress_ui(0, 'preparing to burn OS image..')
 
     # the Windows version of dd can easily output writing progress, unlike OSX and Linux
     # so we do not need multithreading and progress polling
@@ -52,7 +73,12 @@ def start_burn_process(os_info, disk, report_progress_ui):
     successful = burn_kano_os(os_path,
                               disk,
                               os_info['uncompressed_size'],
-                              report_progress_ui)
+                              report_progress_ui,
+                              cancelled)
+
+    if cancelled and cancelled.is_set():
+        debugger('Burning {} cancelled'.format(disk['id_str']))
+        return CANCELLED_ERROR
 
     if not successful:
         return BURN_ERROR
@@ -61,26 +87,31 @@ def start_burn_process(os_info, disk, report_progress_ui):
 
 
 def unzip_kano_os(os_path, dest_path):
-    cmd = '"{}\\7za.exe" e "{}" -o"{}"'.format(_7zip_path, os_path, dest_path)
+    # -y overwrites an image left from an earlier burn instead of asking
+    cmd = '"{}\\7za.exe" e -y "{}" -o"{}"'.format(_7zip_path, os_path, dest_path)
     _, output, return_code = run_cmd_no_pipe(cmd)
 
     if not return_code:
         debugger('Unzipped Kano OS successfully')
+        return True
     else:
         debugger('[ERROR]: ' + output.strip('\n'))
+        return False
 
 
-def burn_kano_os(os_path, disk, size, report_progress_ui):
+def burn_kano_os(os_path, disk, size, report_progress_ui, cancelled=None):
     cmd = '"{}\\dd.exe" if="{}" of="{}" bs=4M --progress'.format(_dd_path, os_path, disk['id_str'])
     # all handles (in, out, err) need to be set due to PyInstaller bundling
-    process = subprocess.Popen(cmd, shell=True, universal_newlines=True,
+    # dd is started without a shell, such that it is dd which is killed when cancelling
+    process = subprocess.Popen(cmd, universal_newlines=True,
                                stdin=subprocess.PIPE, stdout=subprocess.PIPE,
                                stderr=subprocess.PIPE)
     failed = False
     unparsed_line = ''
 
-    # initialise UI timed reporting
+    # initialise UI timed reporting, the speed is measured for this burn only
     previous_timestamp = time.time()
+    last_written_mb = 0
 
     # as long as Popen is running, read it's stderr line by line
     # dd uses a carriage return when printing it's progress, but using
@@ -88,6 +119,11 @@ def burn_kano_os(os_path, disk, size, report_progress_ui):
     for line in iter(process.stderr.readline, ''):
         line = line.strip()
 
+        if cancelled and cancelled.is_set():
+            debugger('Stopping dd, the burning was cancelled')
+            process.kill()
+            break
+
         # looking for dd's progress in the output e.g. '1,234M   \n'
         # and making sure we report to UI at fixed time intervals, not like dd
         elapsed_seconds = time.time() - previous_timestamp
@@ -99,7 +135,8 @@ def burn_kano_os(os_path, disk, size, report_progress_ui):
                 # calculate stats to be reported to UI
                 progress = int(total_written_mb / (size / BYTES_IN_MEGABYTE) * 100)
 
-                speed = calculate_speed(total_written_mb, elapsed_seconds)
+                speed = calculate_speed(total_written_mb - last_written_mb, elapsed_seconds)
+                last_written_mb = total_written_mb
 
                 eta = calculate_eta(total_written_mb, size / BYTES_IN_MEGABYTE, speed)
 
@@ -133,12 +170,7 @@ def burn_kano_os(os_path, disk, size, report_progress_ui):
         return True
 
 
-def calculate_speed(total_written_mb, elapsed_seconds):
-    global last_written_mb
-
-    # calculate how much we've written since previous_timestep
-    newly_written_mb = total_written_mb - last_written_mb
-    last_written_mb = total_written_mb
-
+def calculate_speed(newly_written_mb, elapsed_seconds):
+    # newly_written_mb is how much we've written since previous_timestep
     # return the speed as MB/s
     return float(newly_written_mb) / elapsed_seconds
@@ -23,15 +23,21 @@ import os
 import time
 
 from src.common.utils import run_cmd_no_pipe, write_file_contents, debugger, BYTES_IN_GIGABYTE
+from src.common.utils import MIN_DISK_SIZE, MAX_DISK_SIZE
 from src.common.paths import _nircmd_path, temp_path
 from src.common.errors import FORMAT_ERROR
+from src.common.trace import span
+
+
+# How long we wait for the disk to be accessible again after diskpart, in seconds
+DISK_READY_TIMEOUT = 15
 
 class disk_error(Exception):
     pass
 
 def get_disks_list():
     '''
-    This method is used by the BurnerGUI when the user clicks the ComboBox.
+    This method is used by the DiskMonitor to keep the list of disks up to date.
 
     It grabs all disk physical ids, names, and sizes with one command and
     then parses the output. Sizes will be converted to GB (not GiB).
@@ -93,8 +99,8 @@ def get_disks_list():
             }
 
             # make sure we do not list any potential hard drive or too small SD card
-            if    (disk['size'] < 3.5 or
-                   disk['size'] > 16.5 or
+            if    (disk['size'] < MIN_DISK_SIZE or
+                   disk['size'] > MAX_DISK_SIZE or
                    disk['size'] == -1 or
                    media_type.startswith('Fixed')):
                 debugger('Ignoring {}'.format(disk))
@@ -105,6 +111,15 @@ def get_disks_list():
     return disks
 
 
+def get_device_name(disk_id):
+    '''
+    This method returns a stable name for the disk, used to tell disks apart
+    in the scheduler, the traces and the metrics e.g. \\\\.\\PHYSICALDRIVE2
+    '''
+
+    return '\\\\.\\PHYSICALDRIVE{}'.format(disk_id['id_num'])
+
+
 def prepare_disk(disk_id, report_ui):
     '''
     Windows magic
@@ -117,8 +132,11 @@ def prepare_disk(disk_id, report_ui):
         report_ui('closing all Explorer windows')
         close_all_explorer_windows()
 
+        # unlike on the other platforms, this cannot be skipped
+        # as diskpart clean releases the volumes Windows holds on to
         report_ui('formatting the disk')
-        format_disk(disk_id)
+        with span('format', disk=disk_id['id_num']):
+            format_disk(disk_id)
 
     except disk_error as e:
         return e.args[0]
@@ -144,15 +162,15 @@ def format_disk(disk_id):
     # e.g. \\?\Device\Harddisk[id]\Partition0
     id = int(disk_id['id_num'])  # access by string index alone is dangerous!
 
-    # create a diskpart script to format the given disk
+    # create a diskpart script to format the given disk, one per disk
+    # as several disks may be prepared at the same time
     diskpart_format_script = 'select disk {} \nclean'.format(id)
-    diskpart_script_path = os.path.join(temp_path, "format_disk.txt")
+    diskpart_script_path = os.path.join(temp_path, "format_disk_{}.txt".format(id))
     write_file_contents(diskpart_format_script, diskpart_script_path)
 
     # run the created diskpart script
     cmd = 'diskpart /s {}'.format(diskpart_script_path)
     _, error, return_code = run_cmd_no_pipe(cmd)
-    time.sleep(15)  # diskpart requires a timeout between calls
 
     if not return_code:
         debugger('Formatted disk {} with diskpart'.format(id))
@@ -160,6 +178,40 @@ def format_disk(disk_id):
         debugger('[ERROR] ' + error.strip('\n'))
         raise disk_error(FORMAT_ERROR)
 
+    # the disk is not accessible for a few seconds after diskpart
+    wait_for_disk_ready(id)
+
+
+def wait_for_disk_ready(id):
+    # instead of sleeping for the worst case, we wait until Windows has re-enumerated
+    # the disk and released its volumes, i.e. the disk reports no partitions anymore
+    start = time.time()
+
+    while time.time() - start < DISK_READY_TIMEOUT:
+        partitions = get_partitions_count(id)
+        if partitions == 0:
+            debugger('Disk {} ready after {:.2f}s'.format(id, time.time() - start))
+            return
+        time.sleep(0.5)
+
+    debugger('[ERROR] Disk {} still not ready after {}s'.format(id, DISK_READY_TIMEOUT))
+
+
+def get_partitions_count(id):
+    # returns None if wmic does not know about the disk, e.g. while it is re-enumerated
+    cmd = 'wmic diskdrive where Index={} get Partitions /format:list'.format(id)
+    output, _, return_code = run_cmd_no_pipe(cmd)
+    if return_code:
+        return None
+
+    for line in output.splitlines():
+        if line.startswith('Partitions='):
+            try:
+                return int(line.split('=')[1])
+            except ValueError:
+                return None
+    return None
+
 
 def eject_disk(disk_id):
     '''